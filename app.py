@@ -1,22 +1,167 @@
+import math
 import os
 
-from flask import Flask, render_template, send_from_directory, redirect, url_for
+from flask import Blueprint, Flask, current_app, render_template
+from flask import send_file, send_from_directory, redirect, url_for
+from flask import Response, g, jsonify, request, stream_with_context
 from flask_wtf import FlaskForm
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
-from wtforms import SubmitField
+from wtforms import BooleanField, SubmitField
 from flask_wtf.file import FileField, FileRequired, FileAllowed
 from flask_uploads import configure_uploads, UploadSet
 
-from process import ParseRoster, read_html, only_count
+from cache import RESULT_FORMAT, ResultCache, cache_key, content_hash
+from jobs import JobQueue
+from metrics import metrics, server_timing
+from datastructures import AirportNotKnown
+from export import iter_csv, iter_ndjson
+from process import ParseRoster, read_html_bytes, only_count
+from profiling import profile_roster
+from store import UploadStore
+from search import AirportSearch, airport_record
 
+# Every setting can be overridden by an environment variable with the
+# same name prefixed by ROSTER_, e.g. ROSTER_SECRET_KEY
+DEFAULT_CONFIG = {
+    # Without it a random key is made, sessions end on every restart
+    "SECRET_KEY": "",
+    # Relative to the directory of the app
+    "UPLOADED_HTML_DEST": "uploads",
+    # Caches and the index of uploads, kept out of the uploads folder as
+    # that one is served
+    "CACHE_DIR": "cache",
+    # Total size of stored uploads, least recently used are deleted
+    "UPLOAD_MAX_BYTES": 256 * 1024 * 1024,
+    # In CACHE_DIR if not set
+    "RESULT_CACHE": "",
+    "FRAGMENT_CACHE": "",
+    # Days per page of results, each page is rendered once per roster
+    "RESULTS_PAGE_DAYS": 31,
+    # Parse uploads in the background and let the browser poll for the
+    # result. Jobs live in the process which took the upload.
+    "ASYNC_JOBS": True,
+    "JOB_WORKERS": 2,
+    # Uploads are parsed in memory, raw files are only kept on request or
+    # when auditing, in which case every upload is saved in the background
+    "AUDIT_UPLOADS": False,
+    "MAX_CONTENT_LENGTH": 16 * 1024 * 1024,
+    # Time stages and count items for /metrics, optionally per response
+    "METRICS": True,
+    "SERVER_TIMING": False,
+    # Allow ?profile=1 on results, which parses again under cProfile one
+    # request at a time, so only for debugging
+    "PROFILING": False,
+    # Folder where the processes of a server add up their metrics, each
+    # process only has its own if not set, see gunicorn.conf.py
+    "METRICS_DIR": "",
+}
+# Number of functions shown for /results/<filename>?profile=1
+PROFILE_TOP = 20
+# Version of days.html, raise when it changes to drop cached fragments
+FRAGMENT_FORMAT = 2
+# Formats of /api/results/<filename>
+EXPORT_FORMATS = {"ndjson": (iter_ndjson, "application/x-ndjson"),
+                  "csv": (iter_csv, "text/csv")}
 
-app = Flask(__name__)
+allowed_types = UploadSet("html", ("html", "htm"))
+bp = Blueprint("roster", __name__)
 
-app.config["SECRET_KEY"] = "b5dee181aca93daa90cbe38a0791d175"
-app.config["UPLOADED_HTML_DEST"] = "uploads"
 
-allowed_types = UploadSet("html", ("html", "htm"))
-configure_uploads(app, allowed_types)
+def create_app(config=None):
+    """Create the web app, e.g. for a WSGI server, see wsgi.py.
+
+    :param config: Dictionary of settings which take precedence over
+        the defaults and the environment."""
+
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(environment_config())
+    app.config.update(config or {})
+
+    if not app.config["SECRET_KEY"]:
+        app.logger.warning("ROSTER_SECRET_KEY is not set, using a random "
+                           "key for this process only")
+        app.config["SECRET_KEY"] = os.urandom(16).hex()
+    for key in ("UPLOADED_HTML_DEST", "CACHE_DIR"):
+        app.config[key] = os.path.join(app.root_path, app.config[key])
+    os.makedirs(app.config["CACHE_DIR"], exist_ok=True)
+    if not app.config["RESULT_CACHE"]:
+        app.config["RESULT_CACHE"] = os.path.join(
+            app.config["CACHE_DIR"], "results.sqlite")
+    if not app.config["FRAGMENT_CACHE"]:
+        app.config["FRAGMENT_CACHE"] = os.path.join(
+            app.config["CACHE_DIR"], "fragments.sqlite")
+
+    app.extensions["result_cache"] = ResultCache(app.config["RESULT_CACHE"])
+    app.extensions["fragment_cache"] = ResultCache(
+        app.config["FRAGMENT_CACHE"], max_items=256, name="fragment_cache")
+    app.extensions["job_queue"] = JobQueue(app.config["JOB_WORKERS"])
+    app.extensions["upload_store"] = UploadStore(
+        app.config["UPLOADED_HTML_DEST"], app.config["UPLOAD_MAX_BYTES"],
+        os.path.join(app.config["CACHE_DIR"], "uploads.sqlite"))
+    metrics.enabled = app.config["METRICS"]
+    if app.config["METRICS_DIR"]:
+        metrics.share(app.config["METRICS_DIR"])
+
+    configure_uploads(app, allowed_types)
+    app.register_blueprint(bp)
+    return app
+
+
+def environment_config():
+    """Return settings of DEFAULT_CONFIG found in ROSTER_* variables."""
+
+    config = {}
+    for key, default in DEFAULT_CONFIG.items():
+        value = os.environ.get("ROSTER_" + key)
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            value = value.lower() in ("1", "true", "yes", "on")
+        elif isinstance(default, int):
+            value = int(value)
+        config[key] = value
+    return config
+
+
+def result_cache():
+    return current_app.extensions["result_cache"]
+
+
+def fragment_cache():
+    return current_app.extensions["fragment_cache"]
+
+
+def job_queue():
+    return current_app.extensions["job_queue"]
+
+
+def upload_store():
+    return current_app.extensions["upload_store"]
+
+
+@bp.before_request
+def start_timing():
+    if current_app.config["SERVER_TIMING"] and metrics.enabled:
+        metrics.start_request()
+        g.timed = True
+
+
+@bp.after_request
+def add_server_timing(response):
+    """Tell the browser how long each stage of this request took."""
+
+    if g.get("timed"):
+        timings = metrics.finish_request()
+        if timings:
+            response.headers["Server-Timing"] = server_timing(timings)
+    return response
+
+
+@metrics.timed("render_template")
+def render(template, **context):
+    return render_template(template, **context)
 
 
 class UploadForm(FlaskForm):
@@ -24,10 +169,11 @@ class UploadForm(FlaskForm):
         FileRequired(),
         FileAllowed(allowed_types, "Only HTML files")
     ])
+    keep = BooleanField("Keep a copy of my roster on the server")
     submit = SubmitField("Upload file")
 
 
-@app.route('/', methods=["GET", "POST"])
+@bp.route('/', methods=["GET", "POST"])
 def home():
     """Ask user to upload roster file and present processed results"""
 
@@ -37,32 +183,295 @@ def home():
     if form.validate_on_submit():
         f = form.roster.data
         filename = secure_filename(f.filename)
-        f.save(os.path.join(app.root_path, 'uploads', filename))
-        return redirect(url_for("results", filename=str(filename)))
+        data = f.read()
+        keep = form.keep.data or current_app.config["AUDIT_UPLOADS"]
+
+        # Name may differ from filename when another roster has it
+        stored = upload_store().add(filename, data) if keep else None
+
+        # A roster parsed before is shown straight away, without a job
+        if (current_app.config["ASYNC_JOBS"]
+                and cache_key(content_hash(data)) not in result_cache()):
+            # The job runs outside the app context, so gets what it needs
+            job = job_queue().submit(stored or filename, parse_roster, data,
+                                     result_cache())
+            job.stored = stored
+            return redirect(url_for(".job_status", job_id=job.id))
+        if stored:
+            return redirect(url_for(".results", filename=stored))
+
+        try:
+            digest, days, count = parse_roster(data, result_cache())
+        except AirportNotKnown as e:
+            return render("error.html", errorcode=422,
+                          message=str(e)), 422
+        # No address to page through, so all days in one page
+        return render_results(digest, days, count)
 
     # Nothing submitted so generate form to upload
-    return render_template("upload.html", form=form)
+    return render("upload.html", form=form)
 
 
-@app.route('/results/')
-@app.route('/results/<filename>')
+@bp.route('/results/')
+@bp.route('/results/<filename>')
 def results(filename=None):
     """Ask user to upload roster file and present processed results"""
     if not filename:
         filename = "19-01.htm"
-    filename = os.path.join(app.config["UPLOADED_HTML_DEST"], filename)
-    pr = ParseRoster()
-    days = pr.results(read_html(filename))
-    return render_template("results.html",
-                           days=enumerate(days),
-                           count=only_count(days))
+    profile = None
+    try:
+        data = upload_store().read(filename)
+    except FileNotFoundError:
+        return render("error.html", errorcode=404,
+                      message="File not found"), 404
+    try:
+        if (request.args.get("profile") == "1"
+                and current_app.config["PROFILING"]):
+            # Profile this exact run, the cache would skip the parse
+            days, count, profile = profile_roster(
+                upload_store().resolve(filename), PROFILE_TOP,
+                profile_path(filename))
+            digest = content_hash(data)
+        else:
+            digest, days, count = parse_roster(data, result_cache())
+    except AirportNotKnown as e:
+        return render("error.html", errorcode=422,
+                      message=str(e)), 422
+
+    return render_results(digest, days, count,
+                          request.args.get("page", 1, type=int),
+                          profile=profile,
+                          filename=filename)
+
+
+@bp.route('/api/results/<filename>')
+def api_results(filename):
+    """Stream days and summary of an upload as NDJSON or csv.
+
+    Days are sent while later columns are still being parsed. The ETag
+    only changes with the roster and the format of results, so clients
+    can skip rosters they already have. It does not change with the
+    reference data: airports imported by any roster would change all
+    of them, including that of the roster being parsed."""
+
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify(error="Format must be one of "
+                             + ", ".join(EXPORT_FORMATS)), 400
+    try:
+        data = upload_store().read(filename)
+    except FileNotFoundError:
+        return jsonify(error="File not found"), 404
+
+    digest = content_hash(data)
+    cache = result_cache()
+    cached = cache.get(cache_key(digest))
+    days = cached[0] if cached else stream_days(data, digest, cache)
+    serialize, mimetype = EXPORT_FORMATS[export_format]
+
+    response = Response(stream_with_context(serialize(days)),
+                        mimetype=mimetype)
+    response.set_etag(f"{digest}-{RESULT_FORMAT}-{export_format}")
+    # Nothing is parsed when the client has this version already
+    return response.make_conditional(request)
+
+
+@bp.route('/api/airports')
+def api_airports():
+    """Airports with IATA, ICAO or name starting with ?q=."""
+
+    limit = request.args.get("limit", 10, type=int)
+    found = AirportSearch.current().find(request.args.get("q", ""), limit)
+    return jsonify([airport_record(airport) for airport in found])
+
+
+@bp.route('/api/airports/nearest')
+def api_nearest_airports():
+    """Airports nearest to ?lat=&long=, with their distance in nm."""
 
+    lat = request.args.get("lat", type=float)
+    long = request.args.get("long", type=float)
+    # float() takes nan and inf, which fail every comparison
+    if (lat is None or long is None
+            or not (math.isfinite(lat) and math.isfinite(long))
+            or abs(lat) > 90 or abs(long) > 180):
+        return jsonify(error="Give lat and long in degrees"), 400
+    nearest = AirportSearch.current().nearest(
+        lat, long, request.args.get("k", 5, type=int))
+    return jsonify([dict(airport_record(airport), distance=int(distance))
+                    for airport, distance in nearest])
 
-@app.route('/uploads/<filename>')
+
+@bp.route('/api/airports/distance')
+def api_airport_distance():
+    """Length, sector and nominal value of a flight ?dep= to ?arr=."""
+
+    dep, arr = request.args.get("dep", ""), request.args.get("arr", "")
+    try:
+        length, sector, nominal = AirportSearch.current().distance(dep, arr)
+    except KeyError as e:
+        return jsonify(error=f"Airport not known: {e.args[0]}"), 404
+    except ValueError as e:
+        # Airport without valid coordinates in the reference data
+        return jsonify(error=str(e)), 422
+    return jsonify(dep=dep.upper(), arr=arr.upper(), length=length,
+                   sector=sector, nominal=nominal / 10)
+
+
+@bp.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Show progress of a background parse, or its results when done."""
+
+    job = job_queue().get(job_id)
+    if job is None:
+        return render("error.html", errorcode=404,
+                      message="Job not found"), 404
+    if job.status == "failed":
+        # Same answer as when the upload is parsed in the request
+        code = 422 if isinstance(job.exception, AirportNotKnown) else 500
+        return render("error.html", errorcode=code,
+                      message=job.error), code
+    if job.status == "done":
+        if job.stored:
+            # Kept rosters have an address of their own
+            return redirect(url_for(".results", filename=job.stored))
+        digest, days, count = job.result
+        return render_results(digest, days, count,
+                              request.args.get("page", 1, type=int))
+    return render("job.html", job=job,
+                  position=job_queue().position(job),
+                  stats=job_queue().stats())
+
+
+@bp.route('/jobs/<job_id>/status')
+def job_status_json(job_id):
+    """Progress of a background parse for clients polling for it."""
+
+    job = job_queue().get(job_id)
+    if job is None:
+        return jsonify(error="Job not found"), 404
+    return jsonify(dict(job.as_dict(), position=job_queue().position(job)))
+
+
+@bp.route('/jobs/')
+def job_stats():
+    """Queue depth and average queue and parse times."""
+
+    return jsonify(job_queue().stats())
+
+
+def render_results(digest, days, count, page=None, **context):
+    """Render results page with one page of days, or all of them.
+
+    The summary comes with the cached result. Days are rendered in
+    fragments of RESULTS_PAGE_DAYS, which are cached per roster, so
+    paging through a roster renders every fragment only once.
+
+    :param digest: Content hash of the roster.
+    :param page: Number of the page to show, from 1, None for all days.
+    :param context: More variables for results.html."""
+
+    size = current_app.config["RESULTS_PAGE_DAYS"]
+    pages = max(1, -(-len(days) // size))
+    if page is None:
+        starts = range(0, len(days), size)
+    elif 1 <= page <= pages:
+        starts = [(page - 1) * size]
+    else:
+        return render("error.html", errorcode=404,
+                      message="Page not found"), 404
+
+    fragments = [day_fragment(digest, days, start, size) for start in starts]
+    return render("results.html",
+                  days=Markup("".join(fragments)),
+                  count=count,
+                  page=page,
+                  pages=pages,
+                  **context)
+
+
+def day_fragment(digest, days, start, size):
+    """Return rendered rows of days[start:start + size], cached."""
+
+    key = f"{cache_key(digest)}-{FRAGMENT_FORMAT}-days-{start}-{size}"
+    cache = fragment_cache()
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = render("days.html", days=days[start:start + size],
+                          start=start)
+        cache.put(key, fragment)
+    return fragment
+
+
+def parse_roster(data, cache):
+    """Parse roster from memory, or take it from cache if seen before.
+
+    :param data: Contents of the html roster file as bytes.
+    :param cache: ResultCache of the app.
+    :return: Tuple of content hash, list of DutyDay objects and count of
+        roster items."""
+
+    digest = content_hash(data)
+
+    # Same roster with same reference data has been parsed before
+    cached = cache.get(cache_key(digest))
+    if cached is None:
+        pr = ParseRoster()
+        days = pr.results(read_html_bytes(data))
+        cached = days, only_count(days)
+        # Parsing may add airports, so key on reference data after parse
+        cache.put(cache_key(digest), cached)
+    return (digest,) + cached
+
+
+def stream_days(data, digest, cache):
+    """Yield days of roster while parsing, and cache them when complete."""
+
+    days = []
+    for day in ParseRoster().iter_days(read_html_bytes(data)):
+        days.append(day)
+        yield day
+    cache.put(cache_key(digest), (days, only_count(days)))
+
+
+def profile_path(filename):
+    """Return path of the profile of an upload, without extension."""
+
+    directory = os.path.join(current_app.config["CACHE_DIR"], "profiles")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, secure_filename(filename))
+
+
+@bp.route('/metrics')
+def metrics_page():
+    """Stage timings and counters in Prometheus text format."""
+
+    return Response(metrics.exposition(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+@bp.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOADED_HTML_DEST"],
-                               filename)
+    try:
+        path = upload_store().resolve(filename)
+    except FileNotFoundError:
+        return render("error.html", errorcode=404,
+                      message="File not found"), 404
+    return send_file(path, download_name=filename)
+
+
+@bp.route('/profiles/<filename>')
+def profile_file(filename):
+    """Profile of /results/<filename>?profile=1, as .pstats or .collapsed."""
+
+    if (not current_app.config["PROFILING"]
+            or not filename.endswith((".pstats", ".collapsed"))):
+        return render("error.html", errorcode=404,
+                      message="File not found"), 404
+    return send_from_directory(
+        os.path.join(current_app.config["CACHE_DIR"], "profiles"), filename)
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Development server only, see wsgi.py for production
+    create_app().run(debug=True)
@@ -0,0 +1,148 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import argparse
+import csv
+import functools
+import glob
+import json
+import os
+import pstats
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from process import ParseRoster, read_html, only_count
+from profiling import profile_roster
+from reference import registry
+
+EXTENSIONS = (".htm", ".html")
+
+
+def find_rosters(paths):
+    """Expand directories and glob patterns into a sorted list of files."""
+
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.update(os.path.join(root, name) for name in names
+                             if name.lower().endswith(EXTENSIONS))
+        else:
+            files.update(glob.glob(path) or [path])
+    return sorted(files)
+
+
+def init_worker():
+    """Load roster codes and airports, unless inherited from the parent."""
+
+    registry.current()
+
+
+def parse_file(path, profile=False):
+    """Parse one roster file with its own ParseRoster.
+
+    :param profile: Run under cProfile, see profiling.profile_roster.
+    :return: Tuple of path, summary of roster items and error message."""
+
+    try:
+        if profile:
+            _, count, _ = profile_roster(path)
+            return path, count, None
+        days = ParseRoster().results(read_html(path))
+        return path, only_count(days), None
+    except Exception as e:
+        return path, None, str(e) or type(e).__name__
+
+
+def aggregate(summaries):
+    """Add up the summaries of all files, keeping order of first use."""
+
+    total = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            total[key] = total.get(key, 0) + value
+    if "Total sectors" in total:
+        total["Total sectors"] = round(total["Total sectors"], 1)
+    return total
+
+
+def write_csv(out, results, total):
+    """Write one row per file and a final row with the totals."""
+
+    keys = list(total)
+    writer = csv.writer(out)
+    writer.writerow(["file"] + keys + ["error"])
+    for path, summary, error in results:
+        summary = summary or {}
+        writer.writerow([path] + [summary.get(k, 0) for k in keys]
+                        + [error or ""])
+    writer.writerow(["total"] + [total[k] for k in keys] + [""])
+
+
+def write_json(out, results, total):
+    """Write summaries per file, errors and totals as one JSON object."""
+
+    json.dump({"files": {path: summary
+                         for path, summary, _ in results if summary},
+               "errors": {path: error
+                          for path, _, error in results if error},
+               "total": total},
+              out, indent=2)
+    out.write("\n")
+
+
+def main(argv=None):
+    """Parse rosters in parallel and write summary per file and in total."""
+
+    parser = argparse.ArgumentParser(
+        description="Count roster items of many roster files at once.")
+    parser.add_argument("paths", nargs="+",
+                        help="Roster files, directories or glob patterns.")
+    parser.add_argument("-f", "--format", choices=["csv", "json"],
+                        default="csv", help="Output format (default csv).")
+    parser.add_argument("-o", "--output",
+                        help="File to write to instead of stdout.")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Number of processes (default: all cpus).")
+    parser.add_argument("--profile", type=int, nargs="?", const=20,
+                        default=0, metavar="TOP",
+                        help="Profile every file, save .pstats and "
+                             ".collapsed next to it and print the TOP "
+                             "functions of all files (default 20).")
+    args = parser.parse_args(argv)
+
+    files = find_rosters(args.paths)
+    if not files:
+        parser.error("no roster files found")
+
+    # Forked workers share the reference data loaded here
+    registry.current()
+    with ProcessPoolExecutor(max_workers=args.workers,
+                             initializer=init_worker) as pool:
+        results = list(pool.map(functools.partial(parse_file,
+                                                  profile=args.profile > 0),
+                                files, chunksize=max(1, len(files) // 64)))
+    total = aggregate(summary for _, summary, _ in results if summary)
+
+    write = write_csv if args.format == "csv" else write_json
+    if args.output:
+        with open(args.output, "w", newline="") as out:
+            write(out, results, total)
+    else:
+        write(sys.stdout, results, total)
+
+    if args.profile:
+        profiled = [path + ".pstats" for path, _, error in results
+                    if not error]
+        if profiled:
+            stats = pstats.Stats(*profiled, stream=sys.stderr)
+            stats.sort_stats("tottime").print_stats(args.profile)
+
+    failed = sum(1 for _, _, error in results if error)
+    if failed:
+        print(f"{failed} of {len(files)} rosters could not be parsed.",
+              file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import argparse
+import io
+import os
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from columnar import DayTable
+from datastructures import AirportIndex, Flight
+from process import GND_POS, ParseRoster, read_html, read_stream, tokenize
+from process import only_count
+from reference import data_path, registry
+from synthetic import RosterGenerator
+
+# Row handling as it was before rows were tokenized, for comparison
+LEGACY_SKIP = list(ParseRoster.skip_vals)
+LEGACY_GND_POS = list(GND_POS)
+LEGACY_TIMED = list(ParseRoster.timed_roster_codes)
+
+
+def legacy_classify(row):
+    """Run the string patterns and list scans formerly done on every row."""
+
+    if row in LEGACY_SKIP or len(row) < 3:
+        return None
+    flight_number = re.search(r"[0-9]{3,4}", row)
+    non_flight = re.search(r"[A-Z/]{3,4}", row)
+    if row in LEGACY_GND_POS:
+        pass
+    elif flight_number:
+        flight_number.group()
+    elif non_flight:
+        _ = non_flight.group() in LEGACY_TIMED
+    time_ = re.search(r"[0-9]{2}:[0-9]{2}", row)
+    if not time_ and row not in LEGACY_GND_POS:
+        iata = re.search(r"[A-Z]{3}\Z", row)
+        if iata:
+            re.search(r"\*", row)
+    return time_
+
+
+def per_row(func, rows, repeat=5):
+    """Return best time in nanoseconds per row of calling func on rows."""
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for row in rows:
+            func(row)
+        best = min(best, time.perf_counter() - start)
+    return best / len(rows) * 1e9
+
+
+def bench_rows(rows, repeat=5):
+    """Compare cost per row of legacy and tokenized row classification."""
+
+    def cold(row):
+        tokenize.__wrapped__(row)
+
+    tokenize.cache_clear()
+    return {"legacy regex": per_row(legacy_classify, rows, repeat),
+            "tokenize (uncached)": per_row(cold, rows, repeat),
+            "tokenize (cached)": per_row(tokenize, rows, repeat)}
+
+
+@contextmanager
+def scratch_dir(generator):
+    """Work in a temporary copy of the reference data.
+
+    Airports imported during the benchmark are written to the copy, and
+    all_airports.csv only holds the unknown airports of the generator."""
+
+    original = registry.directory
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("airports.csv", "other_duties.csv"):
+            shutil.copy(data_path(name), directory)
+        files = [os.path.join(directory, name)
+                 for name in generator.write(directory)]
+        AirportIndex.db = None
+        registry.use(directory)
+        try:
+            yield files
+        finally:
+            AirportIndex.db = None
+            registry.use(original)
+
+
+def measure(func, reset=None, repeat=3):
+    """Return result, best wall time and peak traced memory of func.
+
+    :param reset: Called before every run to restore starting state."""
+
+    best = float("inf")
+    for _ in range(repeat):
+        if reset:
+            reset()
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+
+    # Memory is traced in a separate run, tracing slows down the code
+    if reset:
+        reset()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def bench_stages(files, repeat=3):
+    """Time every stage from html file to summary of roster items.
+
+    :return: Dict of stage with wall time and peak memory, and dict with
+        number of rows, days, duty days and flights."""
+
+    airports = dict(Flight.airports_list)
+    with open(data_path("airports.csv"), newline="") as file:
+        airports_csv = file.read()
+
+    def reset_airports():
+        # Unknown airports have to be imported again on every run
+        Flight.airports_list.clear()
+        Flight.airports_list.update(airports)
+        with open(data_path("airports.csv"), "w", newline="") as file:
+            file.write(airports_csv)
+        registry.refresh("airports.csv")
+
+    def read():
+        period = []
+        for file in files:
+            period.extend(read_html(file))
+        return period
+
+    stages = {}
+    period, wall, peak = measure(read, repeat=repeat)
+    stages["read_html"] = wall, peak
+    days, wall, peak = measure(lambda: ParseRoster().results(period),
+                               reset=reset_airports, repeat=repeat)
+    stages["ParseRoster.results"] = wall, peak
+
+    flights = [duty for day in days for duty in day.duties
+               if isinstance(duty, Flight)]
+    _, wall, peak = measure(lambda: [f.distance() for f in flights],
+                            repeat=repeat)
+    stages["Flight.distance"] = wall, peak
+    _, wall, peak = measure(lambda: [d.count_items() for d in days],
+                            repeat=repeat)
+    stages["DutyDay.count_items"] = wall, peak
+    _, wall, peak = measure(lambda: only_count(days), repeat=repeat)
+    stages["only_count"] = wall, peak
+
+    counts = {"rows": sum(map(len, period)), "days": len(period),
+              "duty days": len(days), "flights": len(flights)}
+    return stages, counts
+
+
+def bench_aggregate(rosters, repeat=3):
+    """Compare only_count per roster and per crew with a DayTable.
+
+    :param rosters: List of (crew, month, list of DutyDay objects)."""
+
+    def loop():
+        per_roster = [only_count(days) for _, _, days in rosters]
+        crews = {}
+        for crew, _, days in rosters:
+            crews.setdefault(crew, []).extend(days)
+        return per_roster, [only_count(days) for days in crews.values()]
+
+    def fill():
+        table = DayTable()
+        for crew, month, days in rosters:
+            table.add(days, crew=crew, month=(crew, month))
+        table.columns()
+        return table
+
+    table, fill_wall, _ = measure(fill, repeat=repeat)
+
+    def columnar():
+        return table.group_by("month"), table.group_by("crew")
+
+    (by_month, by_crew), wall, _ = measure(columnar, repeat=repeat)
+    (per_roster, per_crew), loop_wall, _ = measure(loop, repeat=repeat)
+    if (list(by_month.values()) != per_roster
+            or list(by_crew.values()) != per_crew):
+        raise AssertionError("DayTable does not match only_count")
+    return {"only_count loop": loop_wall, "DayTable fill": fill_wall,
+            "DayTable group_by": wall}
+
+
+def print_stages(stages, counts):
+    print(", ".join(f"{v} {k}" for k, v in counts.items()))
+    print(f"{'stage':<22}{'wall ms':>10}{'peak KiB':>10}"
+          f"{'rows/s':>12}{'days/s':>12}")
+    for stage, (wall, peak) in stages.items():
+        print(f"{stage:<22}{wall * 1000:10.2f}{peak / 1024:10.0f}"
+              f"{counts['rows'] / wall:12.0f}{counts['days'] / wall:12.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the parser.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rows = commands.add_parser(
+        "rows", help="Cost per row of classifying roster cells.")
+    rows.add_argument("files", nargs="+", help="Roster html files.")
+    rows.add_argument("-r", "--repeat", type=int, default=5)
+
+    stages = commands.add_parser(
+        "stages", help="Time and memory per stage on synthetic rosters.")
+    stages.add_argument("-m", "--months", type=int, default=12)
+    stages.add_argument("-f", "--flights-per-day", type=float, default=3)
+    stages.add_argument("--standby", type=float, default=0.1,
+                        help="Share of standby days.")
+    stages.add_argument("--ground", type=float, default=0.1,
+                        help="Share of ground duty days.")
+    stages.add_argument("--unknown", type=float, default=0.0,
+                        help="Share of destinations not in airports.csv.")
+    stages.add_argument("-s", "--seed", type=int, default=0)
+    stages.add_argument("-r", "--repeat", type=int, default=3)
+
+    aggregate = commands.add_parser(
+        "aggregate", help="Summaries per roster and per crew.")
+    aggregate.add_argument("-c", "--crews", type=int, default=50)
+    aggregate.add_argument("-m", "--months", type=int, default=12)
+    aggregate.add_argument("-s", "--seed", type=int, default=0)
+    aggregate.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.command == "rows":
+        rows = [row for file in args.files for day in read_html(file)
+                for row in day]
+        print(f"{len(rows)} rows")
+        for name, ns in bench_rows(rows, args.repeat).items():
+            print(f"{name:<22}{ns:8.0f} ns/row")
+    elif args.command == "aggregate":
+        rosters = []
+        for crew in range(args.crews):
+            generator = RosterGenerator(args.months, seed=args.seed + crew)
+            for month, html in generator.rosters():
+                rosters.append((crew, month, ParseRoster().results(
+                    read_stream(io.StringIO(html)))))
+        print(f"{len(rosters)} rosters, "
+              f"{sum(len(days) for _, _, days in rosters)} duty days")
+        for name, wall in bench_aggregate(rosters, args.repeat).items():
+            print(f"{name:<22}{wall * 1000:10.2f} ms")
+    else:
+        generator = RosterGenerator(args.months, args.flights_per_day,
+                                    args.standby, args.ground, args.unknown,
+                                    args.seed)
+        with scratch_dir(generator) as files:
+            print_stages(*bench_stages(files, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+from reference import registry
+
+# Version of the pickled duty classes, raise when their layout changes
+RESULT_FORMAT = 3
+
+
+def content_hash(data):
+    """Return hex digest identifying the contents of an uploaded file."""
+
+    return hashlib.sha256(data).hexdigest()
+
+
+def reference_fingerprint():
+    """Return version of the reference csv files, based on size and mtime.
+
+    Editing either file changes the fingerprint, which invalidates
+    all results cached before the edit."""
+
+    h = hashlib.sha256()
+    for name, stat in registry.stats().items():
+        if stat is not None:
+            h.update(f"{name}:{stat[0]}:{stat[1]}".encode())
+    return h.hexdigest()[:16]
+
+
+def cache_key(digest):
+    """Combine content hash of roster with version of reference data."""
+
+    return f"{digest}-{reference_fingerprint()}-{RESULT_FORMAT}"
+
+
+class ResultCache:
+    """Two tier cache of parsed rosters.
+
+    Recently used results are kept in an in-process LRU, all results are
+    pickled to a SQLite store on disk which is bounded in size."""
+
+    def __init__(self, path, max_items=32, max_bytes=64 * 1024 * 1024,
+                 name="result_cache"):
+        """
+        :param path: Location of the SQLite file.
+        :param max_items: Number of results kept in memory.
+        :param max_bytes: Total size of pickled results kept on disk.
+        :param name: Prefix of the hit and miss counters in metrics."""
+
+        self.path = path
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # Connection with the process which opened it, see db
+        self.connection = None, None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    @property
+    def db(self):
+        """Return SQLite connection of this process, opened on first use.
+
+        A connection must not be shared with a forked child, so workers
+        of a preloading server each open their own."""
+
+        pid, db = self.connection
+        if pid != os.getpid():
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS results ("
+                       "key TEXT PRIMARY KEY, value BLOB, "
+                       "size INTEGER, accessed REAL)")
+            db.commit()
+            self.connection = os.getpid(), db
+        return db
+
+    def __contains__(self, key):
+        """Return whether key is cached, without counting it as a hit."""
+
+        with self.lock:
+            return (key in self.memory
+                    or self.db.execute("SELECT 1 FROM results WHERE key = ?",
+                                       (key,)).fetchone() is not None)
+
+    def get(self, key):
+        """Return cached result or None if key is not known."""
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                metrics.inc(f"{self.name}_hits", tier="memory")
+                return self.memory[key]
+
+            row = self.db.execute("SELECT value FROM results WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                metrics.inc(f"{self.name}_misses")
+                return None
+            metrics.inc(f"{self.name}_hits", tier="disk")
+            self.db.execute("UPDATE results SET accessed = ? WHERE key = ?",
+                            (time.time(), key))
+            self.db.commit()
+            value = pickle.loads(row[0])
+            self.remember(key, value)
+            return value
+
+    def put(self, key, value):
+        """Store result in both tiers and evict the oldest if needed."""
+
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.remember(key, value)
+            self.db.execute("INSERT OR REPLACE INTO results "
+                            "VALUES (?, ?, ?, ?)",
+                            (key, blob, len(blob), time.time()))
+
+            # Drop least recently used results until store fits again
+            total = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            oldest = self.db.execute("SELECT key, size FROM results "
+                                     "ORDER BY accessed")
+            for old_key, size in oldest.fetchall():
+                if total <= self.max_bytes or old_key == key:
+                    break
+                self.db.execute("DELETE FROM results WHERE key = ?",
+                                (old_key,))
+                total -= size
+            self.db.commit()
+
+    def remember(self, key, value):
+        """Add result to the in-memory LRU tier."""
+
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
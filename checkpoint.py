@@ -0,0 +1,108 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import argparse
+import json
+import os
+
+from datastructures import DutyDay
+from files import atomic_write
+from process import ParseRoster, read_html, count_days, summarize
+
+
+class RosterHistory:
+    """Year to date count of roster items, built up one month at a time.
+
+    Stores the state of the parser at the end of the last month, the
+    days of every month and the running count in a JSON file. A new
+    month is parsed on top of the saved state, so earlier months never
+    have to be parsed again."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            data = {"parser": None, "count": {}, "months": []}
+        self.parser = data["parser"]
+        self.count = data["count"]
+        self.months = data["months"]
+
+    def add(self, name, period):
+        """Parse next month and add its days to the running count.
+
+        Days still open at the end of the previous month are finished
+        in this month, so they are counted with this month.
+
+        :param name: Name of the month, e.g. the roster file name.
+        :param period: Columns of the roster, see read_html.
+        :return: List of DutyDay objects finished in this month."""
+
+        if name in self.names():
+            raise ValueError(f"{name} has already been added.")
+
+        parser = self.restore()
+        parser.parse(period)
+        parser.resolve_flights()
+
+        self.count = count_days(parser.days, self.count)
+        self.months.append({"name": name,
+                            "days": [day.to_dict() for day in parser.days]})
+        self.parser = parser.checkpoint()
+        self.save()
+        return parser.days
+
+    def summary(self):
+        """Return summary of all months, as only_count of all of them.
+
+        The duty still open after the last month is included, like it
+        would be when parsing all months at once."""
+
+        parser = self.restore()
+        parser.finish()
+        parser.resolve_flights()
+        return summarize(count_days(parser.days, self.count))
+
+    def days(self, name):
+        """Return the DutyDay objects of one month that was added."""
+
+        for month in self.months:
+            if month["name"] == name:
+                return [DutyDay.from_dict(day) for day in month["days"]]
+        raise KeyError(name)
+
+    def names(self):
+        return [month["name"] for month in self.months]
+
+    def restore(self):
+        """Return parser in the state at the end of the last month."""
+
+        if self.parser is None:
+            return ParseRoster()
+        return ParseRoster.resume(self.parser)
+
+    def save(self):
+        """Write history to disk in one go."""
+
+        atomic_write(self.path, json.dumps({"parser": self.parser,
+                                            "count": self.count,
+                                            "months": self.months}), "w")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Add monthly rosters to a year to date count.")
+    parser.add_argument("history", help="JSON file with the saved count.")
+    parser.add_argument("files", nargs="*",
+                        help="Roster files of the next months, in order.")
+    args = parser.parse_args(argv)
+
+    history = RosterHistory(args.history)
+    for path in args.files:
+        history.add(os.path.basename(path), read_html(path))
+    for item, count in history.summary().items():
+        print(f"{item:<22}{count:>8}")
+
+
+if __name__ == "__main__":
+    main()
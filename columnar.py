@@ -0,0 +1,186 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import numpy as np
+
+from process import summarize
+
+# Keys DutyDay.count_items starts every day with, in its order
+INITIAL = ["num_sectors", "num_flights", "domestic", "asby", "positioning"]
+DAY_AT_WORK, FLYING, GROUND_DUTIES, NIGHT_STOPS = 5, 6, 7, 8
+ASBY_CODES = frozenset(["ASBY", "ADTY"])
+
+
+class DayTable:
+    """Items of duty days in columns, to count many rosters at once.
+
+    Each day is stored as entries of (day, key, value, position), where
+    position is the order in which count_items would add the key to its
+    dictionary. Totals and group-bys are then sums over arrays, and the
+    order of first use is the smallest (day, position) of a key, so the
+    summaries equal only_count including the order of their items."""
+
+    def __init__(self):
+        self.keys = INITIAL + ["day_at_work", "flying", "ground_duties",
+                               "night_stops"]
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+        self.num_days = 0
+        self.day, self.key, self.value, self.position = [], [], [], []
+        # Label name with a value per day, e.g. crew or month
+        self.labels = {}
+        self.arrays = None
+
+    def add(self, days, **labels):
+        """Add days of one roster, with labels to group them by later.
+
+        :param days: List of DutyDay objects.
+        :param labels: Label name with value for all these days,
+            e.g. crew="1234", month="2019-01"."""
+
+        start = self.num_days
+        for day in days:
+            self.add_day(day)
+        for name in labels.keys() | self.labels.keys():
+            column = self.labels.setdefault(name, [None] * start)
+            column.extend([labels.get(name)] * (self.num_days - start))
+        self.arrays = None
+
+    def add_day(self, day): # NOQA
+        """Store the items of one day the way count_items counts them."""
+
+        n = self.num_days
+        sectors = flights = domestic = asby = 0
+        # Keys beyond INITIAL in order of first use, with their value
+        used = {}
+        on_asby = multi_ground = False
+
+        for duty in day.duties:
+            if duty.duty_type == 1:
+                used.setdefault(DAY_AT_WORK, 1)
+                used.setdefault(FLYING, 1)
+                # count_items checks for positioning first, but as its
+                # key is always there, every flight is a normal flight
+                sectors += duty.nominal
+                flights += 1
+                domestic += 1 if duty.domestic else 0
+                if on_asby:
+                    asby -= 1
+                    on_asby = False
+            elif duty.off:
+                used.setdefault(self.key_for(duty.duty_code), 1)
+            elif duty.paid and not multi_ground:
+                used.setdefault(GROUND_DUTIES, 1)
+                used.setdefault(DAY_AT_WORK, 1)
+                multi_ground = True
+            elif duty.duty_code in ASBY_CODES:
+                used.setdefault(DAY_AT_WORK, 1)
+                on_asby = True
+                asby += duty.paid
+        if day.hotel:
+            used.setdefault(NIGHT_STOPS, 1)
+
+        self.day.extend([n] * (len(INITIAL) + len(used)))
+        self.key.extend(range(len(INITIAL)))
+        self.key.extend(used)
+        self.value.extend((sectors, flights, domestic, asby, 0))
+        self.value.extend(used.values())
+        self.position.extend(range(len(INITIAL) + len(used)))
+        self.num_days += 1
+
+    def key_for(self, code):
+        """Return column of an off duty code, adding it when new."""
+
+        if code not in self.key_index:
+            self.key_index[code] = len(self.keys)
+            self.keys.append(code)
+        return self.key_index[code]
+
+    def columns(self):
+        """Return entries as numpy arrays, converted once after adding."""
+
+        if self.arrays is None:
+            self.arrays = (np.array(self.day, dtype=np.int64),
+                           np.array(self.key, dtype=np.int64),
+                           np.array(self.value, dtype=np.int64),
+                           np.array(self.position, dtype=np.int64))
+        return self.arrays
+
+    def counts(self, groups, num_groups):
+        """Sum every key per group and find the order of first use.
+
+        :param groups: Group number of every day.
+        :return: Array of totals and array of order, both per group and
+            key. Order is -1 where a key was never used in a group."""
+
+        day, key, value, position = self.columns()
+        num_keys = len(self.keys)
+        cell = groups[day] * num_keys + key
+
+        totals = np.zeros(num_groups * num_keys, dtype=np.int64)
+        np.add.at(totals, cell, value)
+        # Sort key of first use: day, then position on that day
+        first = np.full(num_groups * num_keys, np.iinfo(np.int64).max)
+        np.minimum.at(first, cell, day * (num_keys + 1) + position)
+        first[first == np.iinfo(np.int64).max] = -1
+        return (totals.reshape(num_groups, num_keys),
+                first.reshape(num_groups, num_keys))
+
+    def raw_count(self, totals, first):
+        """Return dict like count_days, keys in order of first use."""
+
+        used = np.flatnonzero(first >= 0)
+        used = used[np.argsort(first[used], kind="stable")]
+        return {self.keys[k]: int(totals[k]) for k in used}
+
+    def summary(self):
+        """Return summary of all days, equal to only_count."""
+
+        totals, first = self.counts(np.zeros(self.num_days, dtype=np.int64),
+                                    1)
+        return summarize(self.raw_count(totals[0], first[0]))
+
+    def group_by(self, label):
+        """Return summary per value of label, in order of first day.
+
+        Days added without this label are grouped under None."""
+
+        values, groups = self.group_numbers(label)
+        totals, first = self.counts(groups, len(values))
+        return {value: summarize(self.raw_count(totals[g], first[g]))
+                for g, value in enumerate(values)}
+
+    def group_numbers(self, label):
+        """Return label values in order of first use and group per day."""
+
+        column = self.labels.get(label, [None] * self.num_days)
+        numbers = {}
+        groups = np.fromiter((numbers.setdefault(value, len(numbers))
+                              for value in column),
+                             dtype=np.int64, count=self.num_days)
+        return list(numbers), groups
+
+    def percentiles(self, key, q, by=None):
+        """Return percentiles of a count_items key, per day or per group.
+
+        :param key: Key of count_items, e.g. "num_sectors" or "SICK".
+        :param q: Percentile or list of percentiles, 0 to 100.
+        :param by: Label to total the key per group first, e.g. "crew".
+        :return: Percentiles as numpy would give them, sectors as in
+            the summary (not multiplied by 10)."""
+
+        if by is None:
+            groups = np.arange(self.num_days)
+            num_groups = self.num_days
+        else:
+            values, groups = self.group_numbers(by)
+            num_groups = len(values)
+        if num_groups == 0:
+            raise ValueError("No days to take percentiles of.")
+
+        totals, _ = self.counts(groups, num_groups)
+        if key in self.key_index:
+            column = totals[:, self.key_index[key]]
+        else:
+            column = np.zeros(num_groups, dtype=np.int64)
+        if key == "num_sectors":
+            column = column / 10
+        return np.percentile(column, q)
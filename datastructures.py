@@ -1,22 +1,41 @@
 import csv
-from datetime import timedelta
-
-from geopy.distance import great_circle
-
-
-def get_rostercodes():
+import io
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where only threads of one process are serialised
+    fcntl = None
+
+from distances import CONVERSION, SECTORS, DistanceMemo
+from files import atomic_write, temporary_path
+from metrics import metrics
+from reference import Reference, data_path, registry
+
+ALL_AIRPORTS = "all_airports.csv"
+AIRPORT_INDEX = "all_airports.sqlite"
+# Serialises rewrites of airports.csv between threads, airports_lock
+# between processes
+csv_lock = threading.Lock()
+
+
+def get_rostercodes(path=None):
     """Load roster codes from small csv."""
 
-    with open("other_duties.csv", "r", newline="") as f:
+    with open(path or data_path("other_duties.csv"), "r", newline="") as f:
         contents = csv.reader(f, delimiter="|")
         return {row[0]: [row[1], row[2], row[3]]
                 for row in contents}
 
 
-def get_airports():
+def get_airports(path=None):
     """Load airports from frequent airports csv."""
 
-    with open("airports.csv", "r", newline="") as file:
+    with open(path or data_path("airports.csv"), "r", newline="") as file:
         contents = csv.DictReader(file, delimiter="|")
         contents = sorted(contents, key=lambda row: row["Name"])
 
@@ -27,48 +46,203 @@ def get_airports():
                 for row in contents}
 
 
-def time_diff(a, b):
-    """Calculate time difference between two times.
+DAY = 24 * 60
+# Every time of day once, so all duties share the same int and str objects
+CLOCKS = tuple(f"{m // 60:02d}:{m % 60:02d}" for m in range(DAY))
+MINUTES = {clock: m for m, clock in enumerate(CLOCKS)}
+
+
+def to_minutes(time):
+    """Convert "HH:MM" into minutes since midnight, None stays None."""
+
+    if time is None:
+        return None
+    try:
+        return MINUTES[time]
+    except KeyError:
+        return int(time[0:2]) * 60 + int(time[3:5])
+
+
+def to_clock(minutes):
+    """Format minutes since midnight as "HH:MM", None stays None."""
+
+    if minutes is None:
+        return None
+    return CLOCKS[minutes % DAY]
+
+
+def minutes_between(a, b):
+    """Return minutes from time a to time b, b may be on the next day.
+
+    :param a: Minutes since midnight.
+    :param b: Minutes since midnight."""
+
+    return (b - a) % DAY
+
+
+def span(start, end):
+    """Return start and end of an interval, with end after start.
+
+    Times are minutes since midnight of the day the interval starts, so
+    an end after midnight is more than DAY. Unknown start keeps end."""
+
+    if start is None or end is None or end >= start:
+        return start, end
+    return start, start + minutes_between(start, end)
 
-    :returns: timedelta object time in hh:mm
-    """
 
-    def transpose(x): return int("".join([x[0:2], x[3:5]]))
+def build_airport_index(source=None, target=None):
+    """Convert big list of airports into SQLite table keyed by IATA.
 
-    # If b is smaller it means a was previous day
-    day = 0 if transpose(a) <= transpose(b) else 1
-    a = a.split(":")
-    b = b.split(":")
+    Only needs to run once, or again after the big list is updated."""
 
-    return (timedelta(days=day, hours=int(b[0]), minutes=int(b[1]))
-            - timedelta(days=0, hours=int(a[0]), minutes=int(a[1])))
+    source = source or data_path(ALL_AIRPORTS)
+    target = target or data_path(AIRPORT_INDEX)
+    tmp = temporary_path(target)
+
+    with open(source, "r", newline="", encoding='utf-8') as file:
+        contents = csv.DictReader(file)
+        db = sqlite3.connect(tmp)
+        db.execute("CREATE TABLE airports (iata TEXT PRIMARY KEY, "
+                   "icao TEXT, name TEXT, lat TEXT, long TEXT) "
+                   "WITHOUT ROWID")
+        # First row of an IATA code wins, like the linear search did
+        db.executemany("INSERT OR IGNORE INTO airports VALUES (?, ?, ?, ?, ?)",
+                       ((row["iata_code"], row["gps_code"],
+                         row["municipality"], row["latitude_deg"],
+                         row["longitude_deg"])
+                        for row in contents if row["iata_code"]))
+        db.commit()
+        db.close()
+    os.replace(tmp, target)
+
+
+class AirportIndex:
+    """Keeps one connection to the airport index open for all lookups."""
+
+    db = None
+    lock = threading.Lock()
+
+    @classmethod
+    def lookup(cls, codes):
+        """Return dict of IATA code with ICAO, name, latitude, longitude.
+
+        Codes which are not in the index are left out."""
+
+        codes = list(codes)
+        found = {}
+        with cls.lock:
+            if cls.db is None:
+                try:
+                    cls.db = cls.connect()
+                except AirportIndexMissing as e:
+                    # Airports are only looked up when they are not known
+                    e.airport_list = sorted(codes)
+                    raise
+            # Stay below the maximum number of parameters of SQLite
+            for i in range(0, len(codes), 500):
+                chunk = codes[i:i + 500]
+                query = ("SELECT iata, icao, name, lat, long FROM airports "
+                         f"WHERE iata IN ({', '.join('?' * len(chunk))})")
+                for row in cls.db.execute(query, chunk):
+                    found[row[0]] = row[1:]
+        return found
+
+    @staticmethod
+    def connect():
+        """Open index, building it first if missing or outdated.
+
+        :raises AirportIndexMissing: If neither index nor big list exist."""
+
+        source, index = data_path(ALL_AIRPORTS), data_path(AIRPORT_INDEX)
+        if not os.path.exists(index) and not os.path.exists(source):
+            raise AirportIndexMissing([])
+        if (not os.path.exists(index)
+                or (os.path.exists(source)
+                    and os.path.getmtime(source) > os.path.getmtime(index))):
+            build_airport_index(source, index)
+        return sqlite3.connect(index, check_same_thread=False)
+
+
+@metrics.timed("import_airports")
+def import_airports(codes, write=1):
+    """Lookup several airports in big list and save them in one go.
+
+    :param codes: Iterable of IATA codes.
+    :param write: Add the found airports to airports.csv if 1.
+    :return: Dictionary of IATA code with Airport object."""
+
+    codes = {iata: iata.upper() for iata in codes}
+    rows = AirportIndex.lookup(set(codes.values()))
+
+    # Report all unknown airports at once
+    missing = sorted(iata for iata, upper in codes.items()
+                     if upper not in rows)
+    if missing:
+        raise AirportNotKnown(missing)
+
+    airports = {iata: Airport(upper, rows[upper][0], rows[upper][1],
+                              (rows[upper][2], rows[upper][3]))
+                for iata, upper in codes.items()}
+    Flight.distance_memo.extend(airports.values())
+    metrics.inc("airports_imported", len(airports))
+    if write == 1:
+        save_airports(airports.values())
+    return airports
 
 
 def import_airport_data(iata, write=1):
     """Lookup airport data in big list and save in selected airport list."""
 
-    with open("all_airports.csv", "r", newline="", encoding='utf-8') as file:
-        contents = csv.DictReader(file)
-        apd = None
-
-        for row in contents:
-            if row["iata_code"] == iata.upper():
-                apd = Airport(row["iata_code"],
-                              row["gps_code"],
-                              row["municipality"],
-                              (row["latitude_deg"], row["longitude_deg"]))
-                break
-        if not apd:
-            raise AirportNotKnown([iata])
-
-        if write == 1:
-            with open("airports.csv", "a", newline="") as file2:
-                file_writer = csv.writer(file2, delimiter="|")
-                file_writer.writerow([apd.iata,
-                                      apd.icao,
-                                      ascii(apd.name).replace("'", ""),
-                                      apd.coord[0], apd.coord[1]])
-        return apd
+    return import_airports([iata], write=write)[iata]
+
+
+def save_airports(airports):
+    """Append airports to airports.csv with a single atomic write."""
+
+    lines = io.StringIO()
+    file_writer = csv.writer(lines, delimiter="|")
+    for apd in airports:
+        file_writer.writerow([apd.iata,
+                              apd.icao,
+                              ascii(apd.name).replace("'", ""),
+                              apd.coord[0], apd.coord[1]])
+
+    path = data_path("airports.csv")
+    with csv_lock, airports_lock(path):
+        previous = registry.stat("airports.csv")
+        with open(path, "r", newline="") as file:
+            contents = file.read()
+        # Another process may have imported some of them meanwhile
+        known = {line.split("|", 1)[0] for line in contents.splitlines()}
+        new = [line for line in lines.getvalue().splitlines(keepends=True)
+               if line.split("|", 1)[0] not in known]
+        if not new:
+            return
+        if contents and contents[-1] not in "\r\n":
+            contents += "\r\n"
+
+        atomic_write(path, contents + "".join(new), "w")
+        # The airports are added to the loaded ones by the caller, those
+        # of other processes are loaded on the next check
+        registry.refresh("airports.csv", previous)
+
+
+@contextmanager
+def airports_lock(path):
+    """Hold an exclusive lock on path between processes, e.g. workers.
+
+    The lock is on a file of its own, as path is replaced when written."""
+
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
 
 
 class Airport:
@@ -80,6 +254,12 @@ class Airport:
         self.name = name
         self.coord = coord
 
+        # Parse coordinates once, instead of for every flight
+        try:
+            self.latlong = (float(coord[0]), float(coord[1]))
+        except (TypeError, ValueError):
+            self.latlong = (float("nan"), float("nan"))
+
     def __str__(self):
         return (f"{self.name} ({self.iata}) is located at "
                 f"{', '.join(map(str, self.coord))}.")
@@ -91,12 +271,49 @@ class DutyDay:
     including start and end time if applicable.
     """
 
-    def __init__(self, duties, report_time=None, off_duty=None):
+    # No __dict__ per object, a year of rosters holds many of these
+    __slots__ = ("duties", "start_minutes", "end_minutes", "hotel")
+
+    def __init__(self, duties, report_time=None, off_duty=None, hotel=None):
+        """
+        :param report_time: Minutes since midnight.
+        :param off_duty: Minutes since midnight, may be after midnight.
+        :param hotel: Hotel of the night stop after this day, if any."""
+
         self.duties = duties
-        self.start_time = report_time
-        self.end_time = off_duty  # might be after midnight, thus < std
+        self.start_minutes, self.end_minutes = span(report_time, off_duty)
+        self.hotel = hotel
         # TODO standby start will be before report time
 
+    @property
+    def duration(self):
+        """Minutes between report and off duty, None if either unknown."""
+
+        if self.start_minutes is None or self.end_minutes is None:
+            return None
+        return self.end_minutes - self.start_minutes
+
+    def to_dict(self):
+        """Return duty day as plain values, e.g. for a JSON checkpoint."""
+
+        return {"duties": [duty.to_dict() for duty in self.duties],
+                "start": self.start_minutes,
+                "end": self.end_minutes,
+                "hotel": self.hotel}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([duty_from_dict(duty) for duty in data["duties"]],
+                   data["start"], data["end"], data.get("hotel"))
+
+    @property
+    def start_time(self):
+        return to_clock(self.start_minutes)
+
+    @property
+    def end_time(self):
+        return to_clock(self.end_minutes)
+
     def count_items(self):
         """Count the different items of the duties on 1 day."""
 
@@ -137,6 +354,9 @@ class DutyDay:
                 elif duty.duty_code in ["ASBY", "ADTY"]:
                     lv["day_at_work"] = on_asby = True
                     lv["asby"] += duty.paid
+
+        if self.hotel:
+            lv["night_stops"] = 1
         return lv
 
     def __str__(self):
@@ -144,18 +364,39 @@ class DutyDay:
 
 
 class Flight:
-    """Contains information about flight between 2 airports."""
+    """Contains information about flight between 2 airports.
+
+    Airports are stored as index in a table shared by all flights and
+    times as minutes since midnight, the properties give the objects."""
 
-    # Populate list with frequent EZY airports
-    airports_list = get_airports()
+    __slots__ = ("flight_no", "dep_id", "arr_id", "std_minutes",
+                 "sta_minutes", "position", "comeback", "domestic",
+                 "length", "sector_id", "nominal")
+
+    # Frequent EZY airports, loaded on first use
+    airports_list = Reference("airports")
+    # Distances between all pairs of airports in list
+    distance_memo = DistanceMemo()
     simulators = ["XBH", "XCS", "XDH", "XWT", "XSW", "XOL"]
     # Factored length of duty, multiplied by 10
-    conversion = {"s": 8, "m": 12, "l": 15, "xl": 25}
+    conversion = CONVERSION
+    # Sector length categories, index is stored in sector_id
+    sectors = ["Ground return"] + SECTORS
+    sector_ids = {sector: i for i, sector in enumerate(sectors)}
+    # Airports used by flights, index is stored in dep_id and arr_id
+    airport_table = []
+    airport_ids = {}
+    intern_lock = threading.Lock()
     # For switching in jinja template
     duty_type = 1
 
     def __init__(self, flight_no, dep, arr, std, sta,
-                 position=False, comeback=False):
+                 position=False, comeback=False, distance=None):
+        """
+        :param std: Minutes since midnight.
+        :param sta: Minutes since midnight, may be after midnight.
+        :param distance: (length, sector, nominal) if already calculated
+            for a batch of flights, see distances.sector_lengths."""
 
         # First check if airport in small list, else import from big list
         for iata in dep, arr:
@@ -164,20 +405,96 @@ class Flight:
 
         self.comeback = comeback
         self.flight_no = flight_no
-        self.dep = Flight.airports_list[dep]
-        self.arr = Flight.airports_list[arr]
+        self.dep_id = Flight.intern(Flight.airports_list[dep])
+        self.arr_id = Flight.intern(Flight.airports_list[arr])
         self.position = position
-        self.sta = sta  # might be after midnight, thus < std
-        self.sta = std
+        self.std_minutes, self.sta_minutes = span(std, sta)
         self.domestic = (self.dep.icao[:2] == self.arr.icao[:2])
-        self.length, self.sector, self.nominal = self.distance()
+        self.length, sector, self.nominal = self.distance(distance)
+        self.sector_id = Flight.sector_ids[sector]
 
         sim = (dep in Flight.simulators or arr in Flight.simulators)
         if position and (sim and self.length < 15):
             # TODO Ground pos to LGW and MXP not properly calculated
             self.nominal = 0
 
-    def distance(self):
+    @classmethod
+    def intern(cls, airport):
+        """Return index of airport in the table shared by all flights.
+
+        An airport with the same data as the one in the table, e.g. from
+        an unpickled result, reuses its index."""
+
+        i = cls.airport_ids.get(airport.iata)
+        if i is not None and cls.airport_table[i] is airport:
+            return i
+        with cls.intern_lock:
+            i = cls.airport_ids.get(airport.iata)
+            if i is not None:
+                known = cls.airport_table[i]
+                if (known.icao, known.name, known.coord) == (
+                        airport.icao, airport.name, airport.coord):
+                    return i
+            cls.airport_table.append(airport)
+            i = cls.airport_ids[airport.iata] = len(cls.airport_table) - 1
+            return i
+
+    @property
+    def dep(self):
+        return Flight.airport_table[self.dep_id]
+
+    @property
+    def arr(self):
+        return Flight.airport_table[self.arr_id]
+
+    @property
+    def std(self):
+        return to_clock(self.std_minutes)
+
+    @property
+    def sta(self):
+        return to_clock(self.sta_minutes)
+
+    @property
+    def sector(self):
+        return Flight.sectors[self.sector_id]
+
+    def to_dict(self):
+        """Return flight as plain values, e.g. for a JSON checkpoint."""
+
+        return {"type": Flight.duty_type,
+                "flight_no": self.flight_no,
+                "dep": self.dep.iata,
+                "arr": self.arr.iata,
+                "std": self.std_minutes,
+                "sta": self.sta_minutes,
+                "position": self.position,
+                "comeback": self.comeback,
+                "distance": [self.length, self.sector, self.nominal]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create flight again without calculating its distance."""
+
+        return cls(data["flight_no"], data["dep"], data["arr"],
+                   data["std"], data["sta"], data["position"],
+                   data["comeback"], distance=tuple(data["distance"]))
+
+    def __getstate__(self):
+        # Airport indices only hold in this process, so pickle the airports
+        return (self.flight_no, self.dep, self.arr, self.std_minutes,
+                self.sta_minutes, self.position, self.comeback,
+                self.domestic, self.length, self.sector_id, self.nominal)
+
+    def __setstate__(self, state):
+        (self.flight_no, dep, arr, self.std_minutes, self.sta_minutes,
+         self.position, self.comeback, self.domestic, self.length,
+         self.sector_id, self.nominal) = state
+        self.dep_id = Flight.intern(dep)
+        self.arr_id = Flight.intern(arr)
+
+    @metrics.timed("flight_distance")
+    def distance(self, distance=None):
         """
         Calculate distance between 2 airports and return this value as
         length, sector length category and nominal length.
@@ -185,20 +502,11 @@ class Flight:
 
         # Skip the calculation if no take off
         if self.comeback == "R":
-            sector = "Ground return"
-            length = nominal = 0
-        else:
-            length = int(great_circle(self.dep.coord, self.arr.coord).nautical)
-            if length <= 400:
-                sector = "s"
-            elif length <= 1000:
-                sector = "m"
-            elif length <= 1500:
-                sector = "l"
-            else:
-                sector = "xl"
-            nominal = self.conversion[sector]
-        return length, sector, nominal
+            return 0, "Ground return", 0
+        elif distance is None:
+            distance = Flight.distance_memo.sector_lengths(
+                [(self.dep, self.arr)])[0]
+        return distance
 
     def __str__(self):
         if self.position:
@@ -219,32 +527,52 @@ class Flight:
 class OtherDuty:
     """Class of any duty other than a flight."""
 
-    rostercodes = get_rostercodes()
-    paid_codes = [code for code, values in rostercodes.items()
-                  if values[2] == "True"]
-    off_codes = [code for code, values in rostercodes.items()
-                 if values[1] == "off"]
-    gnd_training = [code for code, values in rostercodes.items()
-                    if (values[1] in ["training", "recurrent"]
-                        and values[2] == "True")]
+    rostercodes = Reference("roster_codes")
+    paid_codes = Reference("paid_codes")
+    off_codes = Reference("off_codes")
+    gnd_training = Reference("gnd_training")
     duty_type = 0
 
+    __slots__ = ("duty_code", "start_minutes", "end_minutes", "paid", "off")
+
     def __init__(self, duty_code, start_time=None, end_time=None):
+        """
+        :param start_time: Minutes since midnight.
+        :param end_time: Minutes since midnight, may be after midnight."""
+
         self.duty_code = duty_code
-        self.start_time = start_time
-        self.end_time = end_time
+        self.start_minutes, self.end_minutes = span(start_time, end_time)
         self.paid = (duty_code in OtherDuty.paid_codes)
         self.off = (duty_code in OtherDuty.off_codes)
 
         # Check how much sectors paid out
         if self.paid:
             if self.duty_code in ["ADTY", "ASBY", "OFC4", "OFC8"]:
-                short = (time_diff(self.start_time, self.end_time)
-                         < timedelta(hours=4))
+                short = self.end_minutes - self.start_minutes < 4 * 60
                 self.paid = 1 if short else 2
             elif self.duty_code in OtherDuty.gnd_training:
                 self.paid = 1
 
+    @property
+    def start_time(self):
+        return to_clock(self.start_minutes)
+
+    @property
+    def end_time(self):
+        return to_clock(self.end_minutes)
+
+    def to_dict(self):
+        """Return duty as plain values, e.g. for a JSON checkpoint."""
+
+        return {"type": OtherDuty.duty_type,
+                "duty_code": self.duty_code,
+                "start": self.start_minutes,
+                "end": self.end_minutes}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["duty_code"], data["start"], data["end"])
+
     def __str__(self):
         if not self.paid:
             return f"No paid duty: {self.duty_code}."
@@ -253,6 +581,23 @@ class OtherDuty:
                     f"({self.paid} sector(s) paid).")
 
 
+def reference_loaded(data):
+    """Bring the distance memo up to date with newly loaded airports."""
+
+    Flight.distance_memo.sync(data.airports.values())
+
+
+registry.listeners.append(reference_loaded)
+
+
+def duty_from_dict(data):
+    """Create Flight or OtherDuty from the result of its to_dict."""
+
+    if data["type"] == Flight.duty_type:
+        return Flight.from_dict(data)
+    return OtherDuty.from_dict(data)
+
+
 class AirportNotKnown(Exception):
     """Custom message if number of airports not known."""
 
@@ -263,6 +608,14 @@ class AirportNotKnown(Exception):
         return "Some airports are not defined: " + " ".join(self.airport_list)
 
 
+class AirportIndexMissing(AirportNotKnown):
+    """Airports not known, without a big list to import them from."""
+
+    def __str__(self):
+        return (f"{super().__str__()} ({ALL_AIRPORTS} to import them from "
+                "is missing)")
+
+
 def summary_description(count):
     """Take dict of item count and return pretty name as key."""
 
@@ -274,83 +627,12 @@ def summary_description(count):
                  "flying": "Days flying",
                  "positioning": "Positioning duties",
                  "ground_duties": "Ground duties",
+                 "night_stops": "Night stops",
                  "SICK": "Sick days",
                  "ULV": "Unpaid leave",
                  "OFC": "Office duties"}
     return {full_name[k]: v for k, v in count.items() if k in full_name.keys()}
 
 
-
-# FUNCTIONS BELOW NOT USED
-
-def create_new_airport():
-    """Ask user for airport data and export it to airports.csv."""
-
-    print("Create a new airport with the next 5 questions")
-    iata = validate_input("Type 3 letter IATA code", str.upper, 3, 3)
-    airports_dict = get_airports()
-    if airports_dict.get(iata):
-        return f"Airport {iata} already in list"
-    icao = validate_input("Type 4 letter ICAO code", str.upper, 4, 4)
-    name = validate_input("Type name of airport", str.title, 2, 30)
-    lat = validate_input("Type latitude as 1.234567", float)
-    long = validate_input("Type longitude as 1.234567", float)
-    with open("airports.csv", "a", newline="") as file:
-        filewriter = csv.writer(file, delimiter="|")
-        filewriter.writerow([iata, icao, name, lat, long])
-    return Airport(iata, icao, name, (lat, long))
-
-
-def check_flight_length():
-    """ Ask user for 2 airports and print great circle distance. """
-
-    apt_a = validate_input("Type first IATA", str.upper, 3, 3)
-    apt_b = validate_input("Type second IATA code", str.upper, 3, 3)
-    airports_dict = get_airports()
-    distance = int(great_circle(airports_dict[apt_a].coord,
-                                airports_dict[apt_b].coord)
-                   .nautical)
-    print("The distance between {0} and {1} is {2} nautical miles."
-          .format(airports_dict[apt_a].name,
-                  airports_dict[apt_b].name,
-                  distance))
-
-
-def list_airports():
-    airports_dict = get_airports()
-    print("Available airports are:")
-    for airport in airports_dict.values():
-        print(f"{airport.name} ({airport.iata})")
-
-
-def validate_input(prompt, type_=None, min_=None, max_=None):
-    """ Request user input and clean it before return.
-
-    :param prompt: Question to ask user.
-    :param type_: Type of value asked. str, int, float.
-    :param min_: Minimum length of str of lower value of int.
-    :param max_: Maximum length of str of upper value of int.
-    :return: str, int or float.
-    """
-    if (min_ is not None
-            and max_ is not None
-            and max_ < min_):
-        raise ValueError("min_ must be less than or equal to max_.")
-    while True:
-        ui = input(prompt)
-        if type_ is not None:
-            try:
-                ui = type_(ui)
-            except ValueError:
-                print(f"Input type must be {type_.__name__}")
-                continue
-        if isinstance(ui, str):
-            ui_num = len(ui)
-        else:
-            ui_num = ui
-        if max_ is not None and ui_num > max_:
-            print(f"Input must be less than or equal to {max_}.")
-        elif min_ is not None and ui_num < min_:
-            print(f"Input must be more than or equal to {min_}.")
-        else:
-            return ui
+if __name__ == "__main__":
+    build_airport_index()
@@ -0,0 +1,261 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+# Repository modules are imported in dump only, from the tree under test
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Divergences shown per run, the count covers all of them
+MAX_SHOWN = 10
+# STA of flights of a parser which does not keep it, see describe
+UNKNOWN = "unknown"
+
+
+def describe(days):
+    """Return days as plain values which any version of the parser has.
+
+    The first versions have no std, and set sta to the STD instead,
+    their STA is UNKNOWN.
+
+    :param days: List of DutyDay objects.
+    :return: List of [start, end, hotel, duties] per day."""
+
+    described = []
+    for day in days:
+        duties = []
+        for duty in day.duties:
+            if duty.duty_type == 1:
+                std = getattr(duty, "std", None)
+                times = [std, duty.sta] if std else [duty.sta, UNKNOWN]
+                duties.append(["flight", duty.flight_no, duty.dep.iata,
+                               duty.arr.iata, duty.length, str(duty.sector),
+                               duty.nominal, duty.position, duty.comeback,
+                               duty.domestic] + times)
+            else:
+                duties.append(["duty", duty.duty_code, duty.start_time,
+                               duty.end_time, duty.paid, duty.off])
+        described.append([day.start_time, day.end_time,
+                          getattr(day, "hotel", None), duties])
+    return described
+
+
+def dump(root, manifest, engine="process:ParseRoster", repeat=3):
+    """Parse every case with the engine of the tree at root.
+
+    Runs in a process of its own, so each tree imports its own modules
+    and reads its own reference data.
+
+    :param manifest: Dictionary of case name with list of roster files.
+        Several files are parsed as one period, like consecutive months.
+    :param engine: Class with a results(period) method, as module:name.
+    :return: Dictionary of case with described days and best seconds
+        of the engine, without reading the html."""
+
+    os.chdir(root)
+    sys.path.insert(0, root)
+    module, name = engine.split(":")
+    engine = getattr(importlib.import_module(module), name)
+    read_html = importlib.import_module("process").read_html
+
+    def read(paths):
+        if len(paths) == 1:
+            # Keeps what read_html returns, e.g. the night stops
+            period = read_html(paths[0])
+            if hasattr(period, "columns"):
+                # Columns are made while iterating, which is extraction
+                period.columns = list(period.columns)
+            return period
+        period = []
+        for path in paths:
+            period.extend(read_html(path))
+        return period
+
+    results = {}
+    for case, paths in manifest.items():
+        best = None
+        for _ in range(repeat):
+            # Only the engine is timed, the html extractor is the same
+            # for both unless the trees differ in it
+            period = read(paths)
+            start = time.perf_counter()
+            days = engine().results(period)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results[case] = {"days": describe(days), "seconds": best}
+    return results
+
+
+def run_engine(root, manifest_path, engine, repeat):
+    """Run dump for the tree at root in a new process and return it."""
+
+    env = dict(os.environ)
+    # Each tree uses the reference data it comes with
+    env.pop("ROSTER_DATA_DIR", None)
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "dump", root,
+         manifest_path, "--engine", engine, "--repeat", str(repeat)],
+        cwd=root, env=env, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output)
+
+
+def export_tree(rev, directory):
+    """Write the files of a git revision of this repository to directory."""
+
+    archive = subprocess.run(["git", "archive", "--format=tar", rev],
+                             cwd=HERE, stdout=subprocess.PIPE,
+                             check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+
+
+def generated_cases(directory, seeds=5, months=3, night_stops=0.0):
+    """Write synthetic rosters and return their cases.
+
+    Every month is a case of its own, and all months of a seed together
+    are one more case, for duties continuing into the next month.
+    Standby days are frequent, for ADTY call outs. All destinations are
+    known airports, so neither engine imports any."""
+
+    from synthetic import RosterGenerator
+
+    cases = {}
+    for seed in range(seeds):
+        folder = os.path.join(directory, f"seed{seed}")
+        generator = RosterGenerator(months, standby_share=0.25,
+                                    ground_share=0.1, seed=seed,
+                                    night_stop_share=night_stops)
+        paths = [os.path.join(folder, name)
+                 for name in generator.write(folder)]
+        for path in paths:
+            cases[f"seed{seed}/{os.path.basename(path)}"] = [path]
+        if len(paths) > 1:
+            cases[f"seed{seed}/all"] = paths
+    return cases
+
+
+def compare(reference, candidate):
+    """Return list of (case, day, reference day, candidate day) that differ.
+
+    Day is the index of the first differing day of a case, a missing
+    day is None."""
+
+    divergences = []
+    for case, expected in reference.items():
+        expected, got = expected["days"], candidate[case]["days"]
+        for i in range(max(len(expected), len(got))):
+            a = expected[i] if i < len(expected) else None
+            b = got[i] if i < len(got) else None
+            if a is not None and b is not None:
+                b = without_unknown(a, b)
+            if a != b:
+                divergences.append((case, i, a, b))
+                break
+    return divergences
+
+
+def without_unknown(reference, day):
+    """Return day with the STA left out where the reference has none."""
+
+    duties = [duty[:-1] + [UNKNOWN]
+              if duty[0] == "flight" and known[-1] == UNKNOWN else duty
+              for known, duty in zip(reference[3], day[3])]
+    return day[:3] + [duties + day[3][len(duties):]]
+
+
+def report(reference, candidate, divergences, names):
+    """Print divergences and throughput of both engines."""
+
+    for case, i, a, b in divergences[:MAX_SHOWN]:
+        print(f"{case}: day {i + 1} differs")
+        print(f"  {names[0]}: {json.dumps(a)}")
+        print(f"  {names[1]}: {json.dumps(b)}")
+    print(f"{len(divergences)} of {len(reference)} cases diverge")
+
+    num_days = sum(len(result["days"]) for result in reference.values())
+    print(f"{'engine':<30}{'ms':>10}{'days/s':>12}")
+    totals = []
+    for name, results in zip(names, (reference, candidate)):
+        seconds = sum(result["seconds"] for result in results.values())
+        totals.append(seconds)
+        print(f"{name:<30}{seconds * 1000:>10.1f}"
+              f"{num_days / seconds if seconds else 0:>12.0f}")
+    if totals[1]:
+        print(f"relative throughput {totals[0] / totals[1]:.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare output and speed of two roster parsers.")
+    sub = parser.add_subparsers(dest="command")
+
+    compare_parser = sub.add_parser("compare", help="Run both engines.")
+    compare_parser.add_argument("files", nargs="*",
+                                help="Real roster html files to add.")
+    compare_parser.add_argument("--against", default="HEAD",
+                                help="Git revision or directory with the "
+                                     "reference parser.")
+    compare_parser.add_argument("--engine", default="process:ParseRoster",
+                                help="Candidate class in this tree, as "
+                                     "module:name.")
+    compare_parser.add_argument("-s", "--seeds", type=int, default=5)
+    compare_parser.add_argument("-m", "--months", type=int, default=3)
+    compare_parser.add_argument("--night-stops", type=float, default=0.0,
+                                help="Share of flying days with a night "
+                                     "stop, older parsers ignore them.")
+    compare_parser.add_argument("-r", "--repeat", type=int, default=3)
+
+    dump_parser = sub.add_parser("dump", help="Used by compare.")
+    dump_parser.add_argument("root")
+    dump_parser.add_argument("manifest")
+    dump_parser.add_argument("--engine", default="process:ParseRoster")
+    dump_parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.command == "dump":
+        with open(args.manifest) as file:
+            manifest = json.load(file)
+        # Output of the parser itself would end up in the JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            results = dump(args.root, manifest, args.engine, args.repeat)
+        json.dump(results, sys.stdout)
+        return 0
+    if args.command != "compare":
+        parser.print_help()
+        return 2
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = generated_cases(os.path.join(tmp, "rosters"), args.seeds,
+                                args.months, args.night_stops)
+        for path in args.files:
+            cases[os.path.basename(path)] = [os.path.abspath(path)]
+        manifest = os.path.join(tmp, "manifest.json")
+        with open(manifest, "w") as file:
+            json.dump(cases, file)
+
+        if os.path.isdir(args.against):
+            tree = os.path.abspath(args.against)
+        else:
+            tree = os.path.join(tmp, "reference")
+            export_tree(args.against, tree)
+
+        reference = run_engine(tree, manifest, "process:ParseRoster",
+                               args.repeat)
+        candidate = run_engine(HERE, manifest, args.engine, args.repeat)
+
+    divergences = compare(reference, candidate)
+    report(reference, candidate, divergences,
+           [f"{args.against} ParseRoster", args.engine])
+    return 1 if divergences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
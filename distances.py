@@ -0,0 +1,177 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import math
+import pickle
+import threading
+
+import numpy as np
+
+from files import atomic_write
+from metrics import metrics
+from reference import data_path
+
+# Same mean earth radius as geopy's great_circle, in km
+EARTH_RADIUS = 6371.009
+KM_PER_NM = 1.852
+# Upper limit in nm of each sector length category
+SECTOR_LIMITS = np.array([400, 1000, 1500])
+SECTORS = ["s", "m", "l", "xl"]
+# Factored length of duty, multiplied by 10
+CONVERSION = {"s": 8, "m": 12, "l": 15, "xl": 25}
+NOMINALS = np.array([CONVERSION[sector] for sector in SECTORS])
+MEMO_FILE = "distances.pickle"
+
+
+def great_circle_nm(dep, arr):
+    """Calculate great circle distances for many pairs of coordinates.
+
+    Follows the formula of geopy's great_circle, so the result matches
+    int(great_circle(dep, arr).nautical) for every pair.
+
+    :param dep: Array-like of (latitude, longitude) in degrees.
+    :param arr: Array-like of (latitude, longitude) in degrees.
+    :return: Array of distances in whole nautical miles."""
+
+    dep = np.radians(np.asarray(dep, dtype=np.float64).reshape(-1, 2))
+    arr = np.radians(np.asarray(arr, dtype=np.float64).reshape(-1, 2))
+    if not (np.isfinite(dep).all() and np.isfinite(arr).all()):
+        raise ValueError("Coordinates of some airports are not valid.")
+
+    sin_lat1, cos_lat1 = np.sin(dep[:, 0]), np.cos(dep[:, 0])
+    sin_lat2, cos_lat2 = np.sin(arr[:, 0]), np.cos(arr[:, 0])
+    delta_lng = arr[:, 1] - dep[:, 1]
+    cos_delta_lng, sin_delta_lng = np.cos(delta_lng), np.sin(delta_lng)
+
+    d = np.arctan2(np.sqrt((cos_lat2 * sin_delta_lng) ** 2
+                           + (cos_lat1 * sin_lat2
+                              - sin_lat1 * cos_lat2 * cos_delta_lng) ** 2),
+                   sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lng)
+
+    return (EARTH_RADIUS * d / KM_PER_NM).astype(np.int64)
+
+
+def classify(lengths):
+    """Return sector category index for an array of lengths in nm."""
+
+    return np.searchsorted(SECTOR_LIMITS, lengths, side="left")
+
+
+def sector_lengths(dep, arr):
+    """Calculate length, sector and nominal value for many flights at once.
+
+    :param dep: Array-like of departure (latitude, longitude) in degrees.
+    :param arr: Array-like of arrival (latitude, longitude) in degrees.
+    :return: List of (length, sector, nominal) tuples."""
+
+    if len(dep) == 0:
+        return []
+    lengths = great_circle_nm(dep, arr)
+    categories = classify(lengths)
+    return list(zip(lengths.tolist(),
+                    [SECTORS[c] for c in categories.tolist()],
+                    NOMINALS[categories].tolist()))
+
+
+class DistanceMemo:
+    """Length, sector and nominal value between pairs of airports.
+
+    Keys are sorted pairs of IATA codes, so the direction of the flight
+    does not matter. Filled with all pairs of known airports at once and
+    pickled to disk, so it survives restarts."""
+
+    def __init__(self, name=MEMO_FILE):
+        """
+        :param name: File in the data directory, or an absolute path."""
+
+        self.name = name
+        self.loaded = None
+        self.coords = {}
+        self.pairs = {}
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return data_path(self.name)
+
+    def load(self, airports):
+        """Read memo from disk and add any airports it does not cover.
+
+        :param airports: Iterable of Airport objects."""
+
+        try:
+            with open(self.path, "rb") as f:
+                self.coords, self.pairs = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            self.coords, self.pairs = {}, {}
+        self.loaded = self.path
+        self.extend(airports)
+
+    def sync(self, airports):
+        """Load memo of the data directory if not done yet, else extend."""
+
+        if self.loaded != self.path:
+            self.load(airports)
+        else:
+            self.extend(airports)
+
+    def save(self):
+        """Write memo to disk in one go."""
+
+        atomic_write(self.path, pickle.dumps((self.coords, self.pairs),
+                                             pickle.HIGHEST_PROTOCOL))
+
+    def extend(self, airports):
+        """Add distances from new or moved airports to all known airports.
+
+        :param airports: Iterable of Airport objects."""
+
+        with self.lock:
+            new = {a.iata: a.latlong for a in airports
+                   if all(map(math.isfinite, a.latlong))
+                   and self.coords.get(a.iata) != a.latlong}
+            if not new:
+                return
+
+            # Coordinates of an airport changed, so drop its old pairs
+            moved = new.keys() & self.coords.keys()
+            if moved:
+                self.pairs = {key: value for key, value in self.pairs.items()
+                              if not moved.intersection(key)}
+            self.coords.update(new)
+
+            keys, dep, arr = [], [], []
+            for iata, latlong in new.items():
+                for other, other_latlong in self.coords.items():
+                    key = pair_key(iata, other)
+                    if key not in self.pairs:
+                        self.pairs[key] = None
+                        keys.append(key)
+                        dep.append(latlong)
+                        arr.append(other_latlong)
+            self.pairs.update(zip(keys, sector_lengths(dep, arr)))
+            self.save()
+
+    @metrics.timed("sector_lengths")
+    def sector_lengths(self, flights):
+        """Return (length, sector, nominal) for each (dep, arr) Airport pair.
+
+        Pairs not in memo, e.g. of airports with invalid coordinates, are
+        calculated on the spot."""
+
+        results = [self.pairs.get(pair_key(dep.iata, arr.iata))
+                   for dep, arr in flights]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            calculated = sector_lengths([flights[i][0].latlong
+                                         for i in missing],
+                                        [flights[i][1].latlong
+                                         for i in missing])
+            for i, result in zip(missing, calculated):
+                results[i] = result
+        return results
+
+
+def pair_key(a, b):
+    """Return key of an airport pair regardless of direction."""
+
+    return (a, b) if a <= b else (b, a)
@@ -0,0 +1,95 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import csv
+import io
+import json
+
+from datastructures import AirportNotKnown
+from process import count_days, summarize
+
+CSV_COLUMNS = ["record", "day", "type", "code", "dep", "arr", "start", "end",
+               "length", "sector", "nominal", "paid", "hotel", "value"]
+
+
+def duty_record(duty):
+    """Return Flight or OtherDuty as dict of plain values."""
+
+    if duty.duty_type == 1:
+        return {"type": "flight",
+                "code": duty.flight_no,
+                "dep": duty.dep.iata,
+                "arr": duty.arr.iata,
+                "start": duty.std,
+                "end": duty.sta,
+                "length": duty.length,
+                "sector": duty.sector,
+                "nominal": duty.nominal / 10,
+                "position": duty.position,
+                "comeback": duty.comeback,
+                "domestic": duty.domestic}
+    return {"type": "duty",
+            "code": duty.duty_code,
+            "start": duty.start_time,
+            "end": duty.end_time,
+            "paid": duty.paid,
+            "off": duty.off}
+
+
+def with_summary(days):
+    """Yield ("day", DutyDay) as they come, then ("summary", count).
+
+    The summary is counted along the way, so equals only_count of all
+    days without keeping them. AirportNotKnown ends the stream with
+    ("error", message), as the response has started by then."""
+
+    count = {}
+    try:
+        for day in days:
+            count = count_days([day], count)
+            yield "day", day
+    except AirportNotKnown as e:
+        yield "error", str(e)
+        return
+    yield "summary", summarize(count)
+
+
+def iter_ndjson(days):
+    """Yield one JSON line per duty day, then one with the summary."""
+
+    index = 0
+    for kind, item in with_summary(days):
+        if kind == "day":
+            record = {"type": "day", "day": index,
+                      "start": item.start_time, "end": item.end_time,
+                      "hotel": item.hotel,
+                      "duties": [duty_record(duty) for duty in item.duties]}
+            index += 1
+        elif kind == "summary":
+            record = {"type": "summary", "count": item}
+        else:
+            record = {"type": "error", "message": item}
+        yield json.dumps(record) + "\n"
+
+
+def iter_csv(days):
+    """Yield csv text with one row per duty, then one per summary item."""
+
+    out = io.StringIO()
+    writer = csv.DictWriter(out, CSV_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    index = 0
+    for kind, item in with_summary(days):
+        if kind == "day":
+            for duty in item.duties:
+                writer.writerow(dict(duty_record(duty), record="duty",
+                                     day=index, hotel=item.hotel))
+            index += 1
+        elif kind == "summary":
+            for key, value in item.items():
+                writer.writerow({"record": "summary", "code": key,
+                                 "value": value})
+        else:
+            writer.writerow({"record": "error", "value": item})
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
@@ -0,0 +1,30 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import os
+import threading
+
+
+def temporary_path(path):
+    """Return name next to path, of its own per process and thread."""
+
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def atomic_write(path, data, mode="wb"):
+    """Write file in one go, readers never see half of it.
+
+    The data is written aside and swapped in, so writers at the same
+    time, in other processes or threads, replace each other's file as
+    a whole.
+
+    :param data: bytes, or str for mode "w", which is written as is."""
+
+    tmp = temporary_path(path)
+    try:
+        with open(tmp, mode, newline=None if "b" in mode else "") as file:
+            file.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
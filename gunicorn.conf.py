@@ -0,0 +1,48 @@
+#  Copyright (c) 2020. Rinze Douma
+
+# Serve with: gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+import shutil
+
+wsgi_app = "wsgi:application"
+bind = os.environ.get("ROSTER_BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("ROSTER_WORKERS",
+                             min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.environ.get("ROSTER_THREADS", 2))
+# Load the app and reference data in the master, before forking
+preload_app = True
+timeout = 60
+accesslog = "-"
+
+# Jobs are kept by the worker which took the upload, while polling may
+# reach any worker, so parse during the request with more than one
+if workers > 1:
+    os.environ.setdefault("ROSTER_ASYNC_JOBS", "0")
+# Metrics are counted by each worker too, /metrics adds them up from here
+metrics_dir = os.environ.setdefault(
+    "ROSTER_METRICS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "cache", "metrics"))
+
+
+def on_starting(server):
+    # Metrics of an earlier run would be counted again
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def when_ready(server):
+    from metrics import metrics
+    metrics.flush()
+
+
+def post_fork(server, worker):
+    # What the master counted while loading is in its own file already
+    from metrics import metrics
+    metrics.reset()
+
+
+def post_request(worker, req, environ, resp):
+    from metrics import metrics
+    metrics.flush()
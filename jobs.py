@@ -0,0 +1,117 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """Roster waiting for, or done with, parsing in the background."""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        # Message for the user, and the exception to tell its kind
+        self.error = None
+        self.exception = None
+        # Name the upload is kept under, None if it is not kept
+        self.stored = None
+
+    @property
+    def queue_time(self):
+        """Seconds between submitting and start of parsing."""
+
+        return (self.started or time.time()) - self.submitted
+
+    @property
+    def parse_time(self):
+        """Seconds spent parsing so far, None if not started."""
+
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def as_dict(self):
+        return {"id": self.id,
+                "name": self.name,
+                "stored": self.stored,
+                "status": self.status,
+                "queue_time": round(self.queue_time, 3),
+                "parse_time": (round(self.parse_time, 3)
+                               if self.parse_time is not None else None),
+                "error": self.error}
+
+
+class JobQueue:
+    """Local pool of worker threads parsing rosters in the background."""
+
+    def __init__(self, workers=2, keep=200):
+        """
+        :param workers: Number of rosters parsed at the same time.
+        :param keep: Number of jobs remembered, oldest are forgotten."""
+
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix="roster-job")
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, name, func, *args):
+        """Queue func(*args) and return Job to follow its progress."""
+
+        job = Job(name)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep:
+                self.jobs.popitem(last=False)
+        self.pool.submit(self.run, job, func, *args)
+        return job
+
+    @staticmethod
+    def run(job, func, *args):
+        job.started = time.time()
+        job.status = "running"
+        try:
+            job.result = func(*args)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            job.exception = e
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def position(self, job):
+        """Number of queued jobs ahead of job."""
+
+        with self.lock:
+            queued = [j for j in self.jobs.values() if j.status == "queued"]
+        return sum(1 for j in queued if j.submitted < job.submitted)
+
+    def stats(self):
+        """Queue depth and average times of the remembered jobs."""
+
+        with self.lock:
+            jobs = list(self.jobs.values())
+        finished = [j for j in jobs if j.finished is not None]
+        started = [j for j in jobs if j.started is not None]
+        return {"queued": sum(1 for j in jobs if j.status == "queued"),
+                "running": sum(1 for j in jobs if j.status == "running"),
+                "done": sum(1 for j in jobs if j.status == "done"),
+                "failed": sum(1 for j in jobs if j.status == "failed"),
+                "avg_queue_time": round(
+                    sum(j.queue_time for j in started) / len(started), 3)
+                if started else None,
+                "avg_parse_time": round(
+                    sum(j.parse_time for j in finished) / len(finished), 3)
+                if finished else None}
@@ -0,0 +1,179 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urljoin
+from urllib.request import HTTPCookieProcessor, Request, build_opener
+
+from synthetic import RosterGenerator
+
+CSRF_TOKEN = re.compile(rb'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Client:
+    """Browser session against the app: cookies, CSRF token and jobs."""
+
+    def __init__(self, base_url, poll_interval=0.05):
+        self.base_url = base_url
+        self.poll_interval = poll_interval
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def get(self, path):
+        """Return final url and body of a GET request."""
+
+        with self.opener.open(urljoin(self.base_url, path)) as response:
+            return response.geturl(), response.read()
+
+    def upload(self, name, data):
+        """Post roster like the upload form does.
+
+        :return: Final url and body after following redirects."""
+
+        _, page = self.get("/")
+        match = CSRF_TOKEN.search(page)
+        fields = {"csrf_token": match.group(1)} if match else {}
+        body, content_type = multipart(fields, "roster", name, data)
+        request = Request(urljoin(self.base_url, "/"), data=body,
+                          headers={"Content-Type": content_type})
+        with self.opener.open(request) as response:
+            return response.geturl(), response.read()
+
+    def wait(self, job_url):
+        """Poll job until it is finished, then return body of its page."""
+
+        while True:
+            _, body = self.get(job_url + "/status")
+            status = json.loads(body)["status"]
+            if status in ("done", "failed"):
+                return self.get(job_url)[1]
+            time.sleep(self.poll_interval)
+
+
+def multipart(fields, file_field, filename, data):
+    """Encode form fields and one file as multipart/form-data."""
+
+    boundary = uuid.uuid4().hex.encode()
+    parts = []
+    for name, value in fields.items():
+        parts.append(b"--%s\r\nContent-Disposition: form-data; "
+                     b'name="%s"\r\n\r\n%s\r\n'
+                     % (boundary, name.encode(), value))
+    parts.append(b"--%s\r\nContent-Disposition: form-data; "
+                 b'name="%s"; filename="%s"\r\n'
+                 b"Content-Type: text/html\r\n\r\n%s\r\n"
+                 % (boundary, file_field.encode(), filename.encode(), data))
+    parts.append(b"--%s--\r\n" % boundary)
+    return (b"".join(parts),
+            "multipart/form-data; boundary=" + boundary.decode())
+
+
+def session(client, rosters, count, unique, timings, errors, lock):
+    """Upload rosters one after another and time each step.
+
+    Upload is the time until the server answered the post, results the
+    time until the parsed roster was shown, which includes the upload."""
+
+    for i in range(count):
+        name, html = rosters[i % len(rosters)]
+        data = html.encode()
+        if unique:
+            # Different content, so the result cache doesn't answer it
+            data += b"<!-- %s -->" % uuid.uuid4().hex.encode()
+        try:
+            start = time.perf_counter()
+            url, body = client.upload(name, data)
+            uploaded = time.perf_counter()
+            if "/jobs/" in url:
+                body = client.wait(url)
+            done = time.perf_counter()
+        except (HTTPError, OSError) as e:
+            with lock:
+                errors.append(str(e))
+            continue
+        with lock:
+            if b"Total sectors" not in body:
+                errors.append(f"{name}: no results in response")
+            timings["upload"].append(uploaded - start)
+            timings["results"].append(done - start)
+
+
+def percentile(values, q):
+    """Return q-th percentile of values, nearest rank."""
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def run(url, rosters, requests=100, concurrency=8, unique=True):
+    """Upload rosters from concurrent clients and time the responses.
+
+    :param rosters: List of (file name, html) to upload in turn.
+    :return: Dictionary of step with list of seconds, list of errors and
+        wall time of the whole run."""
+
+    timings = {"upload": [], "results": []}
+    errors = []
+    lock = threading.Lock()
+    threads = []
+    for n in range(concurrency):
+        # Spread the requests over the clients
+        count = requests // concurrency + (n < requests % concurrency)
+        thread = threading.Thread(target=session, args=(
+            Client(url), rosters, count, unique, timings, errors, lock))
+        threads.append(thread)
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, errors, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load test a running server with roster uploads.")
+    parser.add_argument("url", nargs="?", default="http://127.0.0.1:8000")
+    parser.add_argument("-n", "--requests", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-m", "--months", type=int, default=3,
+                        help="Number of synthetic rosters to upload.")
+    parser.add_argument("--cached", action="store_true",
+                        help="Upload the same content again, so results "
+                             "come from the cache.")
+    parser.add_argument("files", nargs="*",
+                        help="Roster html files instead of synthetic ones.")
+    args = parser.parse_args(argv)
+
+    if args.files:
+        rosters = []
+        for path in args.files:
+            with open(path, "r") as file:
+                rosters.append((path.rsplit("/", 1)[-1], file.read()))
+    else:
+        rosters = RosterGenerator(args.months).rosters()
+
+    timings, errors, wall = run(args.url, rosters, args.requests,
+                                args.concurrency, not args.cached)
+    done = len(timings["results"])
+    print(f"{done} rosters in {wall:.2f} s, {done / wall:.1f}/s, "
+          f"{len(errors)} errors")
+    if done:
+        print(f"{'step':<10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for step, values in timings.items():
+            print(f"{step:<10}{percentile(values, 50) * 1000:>10.1f}"
+                  f"{percentile(values, 99) * 1000:>10.1f}"
+                  f"{max(values) * 1000:>10.1f}")
+    for error in errors[:5]:
+        print("error:", error)
+
+
+if __name__ == "__main__":
+    main()
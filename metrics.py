@@ -0,0 +1,184 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import functools
+import json
+import os
+import threading
+import time
+
+from files import atomic_write
+
+PREFIX = "roster"
+
+
+class Metrics:
+    """Time spent per stage and counters, kept in memory of this process.
+
+    Disabled by default. Timed functions then only pay for checking the
+    enabled flag, so the hooks can stay on the hot path."""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # Stage with number of calls and total seconds
+        self.timers = {}
+        # (name, labels) with value
+        self.counters = {}
+        # Timings of the request handled by this thread
+        self.local = threading.local()
+        # Folder shared by the processes of a server, see share
+        self.directory = None
+        self.process = None, None
+        self.flush_lock = threading.Lock()
+
+    def timed(self, stage):
+        """Decorator adding the duration of every call to stage."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(stage, time.perf_counter() - start)
+            # Own name per stage, else profiles merge all timed functions
+            wrapper.__code__ = wrapper.__code__.replace(
+                co_name=f"timed_{stage}")
+            return wrapper
+        return decorator
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(stage, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+        request = getattr(self.local, "request", None)
+        if request is not None:
+            request[stage] = request.get(stage, 0.0) + seconds
+
+    def inc(self, name, value=1, **labels):
+        """Add value to counter name, e.g. inc("cache_hits", tier="disk")."""
+
+        if not self.enabled:
+            return
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def start_request(self):
+        """Collect timings of this thread from now on, for one request."""
+
+        self.local.request = {}
+
+    def finish_request(self):
+        """Stop collecting and return dict of stage with seconds."""
+
+        request = getattr(self.local, "request", None) or {}
+        self.local.request = None
+        return request
+
+    def reset(self):
+        """Forget all values, e.g. those a forked worker got from parent."""
+
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+    def share(self, directory):
+        """Add up the values of all processes writing to directory.
+
+        Every process keeps its own values in memory, so a server with
+        several workers would show those of whichever worker answers.
+        With a shared directory each process writes its values to a file
+        of its own on flush, and exposition adds up all files. Files of
+        stopped processes stay, so counters never go down."""
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def flush(self):
+        """Write values of this process to the shared directory, if any."""
+
+        if self.directory is None:
+            return
+        # Threads of a worker flush one after another, so the file of
+        # the process is made once and never replaced by an older state
+        with self.flush_lock:
+            pid, path = self.process
+            if pid != os.getpid():
+                # A new pid may be an old one reused, so add start time
+                path = os.path.join(self.directory,
+                                    f"{os.getpid()}-{time.time_ns()}.json")
+                self.process = os.getpid(), path
+            with self.lock:
+                state = {"timers": list(self.timers.items()),
+                         "counters": [[name, labels, value]
+                                      for (name, labels), value
+                                      in self.counters.items()]}
+            atomic_write(path, json.dumps(state), "w")
+
+    def collect(self):
+        """Return timers and counters, of all processes when shared."""
+
+        if self.directory is None:
+            with self.lock:
+                return dict(self.timers), dict(self.counters)
+
+        self.flush()
+        timers, counters = {}, {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as file:
+                    state = json.load(file)
+            except (FileNotFoundError, ValueError):
+                # Gone, or not written by flush
+                continue
+            for stage, (count, total) in state["timers"]:
+                timer = timers.setdefault(stage, [0, 0.0])
+                timer[0] += count
+                timer[1] += total
+            for name, labels, value in state["counters"]:
+                key = name, tuple(map(tuple, labels))
+                counters[key] = counters.get(key, 0) + value
+        return timers, counters
+
+    def exposition(self):
+        """Return all timers and counters in Prometheus text format."""
+
+        timers, counters = self.collect()
+        timers = sorted(timers.items())
+        counters = sorted(counters.items())
+
+        lines = [f"# HELP {PREFIX}_stage_seconds Time spent per stage.",
+                 f"# TYPE {PREFIX}_stage_seconds summary"]
+        for stage, (count, total) in timers:
+            lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} '
+                         f"{count}")
+            lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} '
+                         f"{total:.6f}")
+
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{PREFIX}_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{metric}{{{label_text}}} {value}" if labels
+                         else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def server_timing(timings):
+    """Format dict of stage with seconds as Server-Timing header value."""
+
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}"
+                     for stage, seconds in timings.items())
+
+
+metrics = Metrics()
@@ -1,37 +1,64 @@
 
 #  Copyright (c) 2020. Rinze Douma
 
+import io
 import re
-from collections import defaultdict
-
-from datetime import timedelta
-from bs4 import BeautifulSoup
-
-from datastructures import DutyDay, Flight, OtherDuty, get_rostercodes
-from datastructures import time_diff, summary_description
-
-GND_POS = ["OWN", "TAXI", "TRN", "NSO"]
+from collections import Counter, defaultdict, namedtuple
+from functools import lru_cache
+from html.parser import HTMLParser
+
+from datastructures import DutyDay, Flight, OtherDuty
+from datastructures import import_airports, summary_description
+from datastructures import duty_from_dict, minutes_between, to_minutes
+from metrics import metrics
+from reference import Reference, registry
+
+GND_POS = frozenset(["OWN", "TAXI", "TRN", "NSO"])
+# Gap after which the next time starts a new duty day, in minutes
+NEW_DAY_GAP = 9 * 60
+# Characters read from the roster file per call to the html parser
+CHUNK_SIZE = 64 * 1024
+
+FLIGHT_NUMBER = re.compile(r"[0-9]{3,4}")
+NON_FLIGHT = re.compile(r"[A-Z/]{3,4}")
+TIME = re.compile(r"[0-9]{2}:[0-9]{2}")
+IATA = re.compile(r"[A-Z]{3}\Z")
+# Hotel block below the roster table, with the dates of the night stops
+HOTEL = re.compile(r"[A-Za-z]{6,12}[ \xa0]HOTEL")
+NIGHT_STOP_DATE = re.compile(r"[A-Z][a-z]{2}[0-9]{2}")
+
+# Kind is "skip" or "ground" for rows known at first sight, else None.
+# The fields hold every match, the parser decides on some of them
+# depending on its state.
+Token = namedtuple("Token", ["kind", "text", "flight_number", "comeback",
+                             "duty", "timed", "time", "iata", "star"])
 
 
 class ParseRoster:
     """Class to convert items on roster to countable values."""
 
-    roster_codes = get_rostercodes()
-    timed_roster_codes = [code
-                          for code, values in roster_codes.items()
-                          if values[0] == "True"]
-    skip_vals = ["None", " EJU", " ", "Block", "Duty", " OWNA",
-                 "(320)", "(321)", "EZS", " EZS", "SNCR"]
+    roster_codes = Reference("roster_codes")
+    timed_roster_codes = Reference("timed_codes")
+    skip_vals = frozenset(["None", " EJU", " ", "Block", "Duty", " OWNA",
+                           "(320)", "(321)", "EZS", " EZS", "SNCR"])
     cont_times = ["report_time", "start_time", "STD", "STA"]
 
     def __init__(self):
         """
         :param self.lv: Store local values for working on roster decryption.
-        :param self.duties: Store each duty as a Flight or OtherDuty class."""
+        :param self.duties: Store each duty as a Flight or OtherDuty class.
+        :param self.flights: Flights waiting for their airports, as
+            (list of duties, position in list, Flight arguments)."""
         self.continued_duty = False
         self.lv = {}
         self.duties = []
         self.days = []
+        self.flights = []
+        # Column being parsed, day of month of the night stops of the
+        # period with their hotel, and hotel of the day being parsed
+        self.column = 0
+        self.hotels = {}
+        self.day_hotel = None
 
     def results(self, period):
         """Take list of roster days and return list of DutyDay objects.
@@ -39,9 +66,69 @@ class ParseRoster:
         :param period: List of list containing rows with duty elements.
         :return: List of DutyDay objects."""
 
-        # Convert raw roster into days-list
-        for d in period:
+        self.parse(period)
+        self.finish()
+        self.resolve_flights()
+        return self.days
+
+    def parse(self, period):
+        """Convert raw roster into days, leaving the last duty open.
+
+        More periods can be parsed after this one, or the state can be
+        saved with checkpoint to continue later."""
+
+        # Reload changed reference data before cached tokens are used
+        registry.current()
+        self.start_period(period)
+        days = rows = 0
+        for column, d in enumerate(period):
+            self.column = column
+            self.parse_day(d)
+            days += 1
+            rows += len(d)
+        metrics.inc("days_parsed", days)
+        metrics.inc("rows_parsed", rows)
+
+    def iter_days(self, period):
+        """Parse roster and yield each DutyDay as soon as it is finished.
+
+        Airports of finished days are imported per column, so the first
+        days are available long before the last column is parsed."""
+
+        registry.current()
+        self.start_period(period)
+        days = rows = 0
+        for column, d in enumerate(period):
+            self.column = column
             self.parse_day(d)
+            days += 1
+            rows += len(d)
+            if self.days:
+                yield from self.finished_days()
+        self.finish()
+        yield from self.finished_days()
+        metrics.inc("days_parsed", days)
+        metrics.inc("rows_parsed", rows)
+
+    def start_period(self, period):
+        """Take the night stops of a period read by read_html, if any.
+
+        Column n of the period is day n of the month, column 0 holds
+        the row labels."""
+
+        self.hotels = dict.fromkeys(getattr(period, "night_stops", ()),
+                                    getattr(period, "hotel", None))
+
+    def finished_days(self):
+        """Hand over finished days, with their flights resolved."""
+
+        self.resolve_flights()
+        days, self.days = self.days, []
+        return days
+
+    def finish(self):
+        """Close the last duty once no more roster days will follow."""
+
         # It might be that last duty was unfinished
         if self.lv.get("previous_item") in ParseRoster.cont_times:
             self.continued_duty = True
@@ -49,38 +136,79 @@ class ParseRoster:
         elif len(self.duties) > 0:
             self.clean_up(end_of_duty=True)
 
-        return self.days
-
-    def search_duty_type(self, row):
+    def checkpoint(self):
+        """Return state of parser between two periods as plain values.
+
+        Days already returned are not part of it, only what is needed to
+        continue parsing with resume."""
+
+        self.resolve_flights()
+        return {"lv": dict(self.lv),
+                "duties": [duty.to_dict() for duty in self.duties],
+                "continued_duty": self.continued_duty,
+                "day_hotel": self.day_hotel}
+
+    @classmethod
+    def resume(cls, checkpoint):
+        """Create parser which continues where checkpoint was made."""
+
+        parser = cls()
+        parser.lv.update(checkpoint["lv"])
+        parser.duties = [duty_from_dict(duty)
+                         for duty in checkpoint["duties"]]
+        parser.continued_duty = checkpoint["continued_duty"]
+        parser.day_hotel = checkpoint.get("day_hotel")
+        return parser
+
+    def resolve_flights(self):
+        """Replace pending flights by Flight objects.
+
+        All airports not yet known are imported in a single lookup, so a
+        roster with several new airports reports all of them at once.
+        Distances of all flights come from the memo of airport pairs."""
+
+        airports = Flight.airports_list
+        missing = {iata
+                   for _, _, flight in self.flights
+                   for iata in flight[1:3]
+                   if iata not in airports}
+        if missing:
+            airports.update(import_airports(missing))
+
+        distances = Flight.distance_memo.sector_lengths(
+            [(airports[flight[1]], airports[flight[2]])
+             for _, _, flight in self.flights])
+        for (duties, i, flight), distance in zip(self.flights, distances):
+            duties[i] = Flight(*flight, distance=distance)
+        self.flights = []
+
+    def search_duty_type(self, token):
         """Interpret what item in current row is."""
 
-        search_flight_number = re.search(r"[0-9]{3,4}", row)
-        search_non_flight = re.search(r"[A-Z/]{3,4}", row)
-
         # Ground positioning
-        if row in GND_POS:
+        if token.kind == "ground":
             # Takes into account taxi between bases. Flt no used for switching
             self.lv["position"] = "ground"
-            self.lv["flight_number"] = row
+            self.lv["flight_number"] = token.text
 
         # Flight
-        elif search_flight_number:
-            self.lv["flight_number"] = search_flight_number.group()
+        elif token.flight_number:
+            self.lv["flight_number"] = token.flight_number
 
             # Either ground or air return, instead of scheduled route
-            if row[-1] == "R" or row[-1] == "A":
-                self.lv["comeback"] = row[-1]
+            if token.comeback:
+                self.lv["comeback"] = token.comeback
 
             # If end_time set, it means a duty from previous day is not saved.
-            if self.lv.get("end_time"):
+            if self.lv.get("end_time") is not None:
                 self.clean_up()
 
         # Other duty type
-        elif search_non_flight and "flight_number" not in self.lv:
-            self.lv["other_duty"] = search_non_flight.group()
+        elif token.duty and "flight_number" not in self.lv:
+            self.lv["other_duty"] = token.duty
 
             # Many other duties do not have times associated.
-            if self.lv["other_duty"] not in ParseRoster.timed_roster_codes:
+            if not token.timed:
                 self.lv["no_time"] = True
 
     def time_details(self, search_time, prev):
@@ -111,17 +239,17 @@ class ParseRoster:
         self.lv[time_type] = search_time
         self.lv["previous_item"] = time_type
 
-    def flight_details(self, row, search_iata):
+    def flight_details(self, token):
         """Determine whether flight is a positioning duty and set dep/arr."""
 
-        if self.lv.get("position") != "ground" and re.search(r"\*", row):
+        if self.lv.get("position") != "ground" and token.star:
             self.lv["position"] = "air"
 
         # Set departure and arrival airfields
         if "dep" not in self.lv:
-            self.lv["dep"] = search_iata.group()
+            self.lv["dep"] = token.iata
         else:
-            self.lv["arr"] = search_iata.group()
+            self.lv["arr"] = token.iata
 
     def clean_up(self, end_of_duty=False, keep_duty_type=False):
         """
@@ -135,8 +263,10 @@ class ParseRoster:
         if end_of_duty:
             self.days.append(DutyDay(self.duties,
                                      report_time=self.lv.get("report_time"),
-                                     off_duty=self.lv.get("off_time")))
+                                     off_duty=self.lv.get("off_time"),
+                                     hotel=self.day_hotel))
             self.duties = []
+            self.day_hotel = None
 
             # Keep_duty_type signals new duty has already begun,
             # so save data from the new day.
@@ -149,7 +279,7 @@ class ParseRoster:
         # One duty has finished, not the day completely
         else:
             report = self.lv.get("report_time")
-            if report:
+            if report is not None:
                 save_vals.update({"report_time": report,
                                   "previous_item": "report_time"})
 
@@ -165,6 +295,15 @@ class ParseRoster:
         self.lv.clear()
         self.lv.update(save_vals)
 
+    def add_duty(self, duty):
+        """Add duty to the day. A day has a night stop when its first
+        duty is in the column of a date listed in the hotel block."""
+
+        if not self.duties:
+            self.day_hotel = self.hotels.get(self.column)
+        self.duties.append(duty)
+
+    @metrics.timed("parse_day")
     def parse_day(self, day): # NOQA
         """For one day, loop through all rows and extract duties and times."""
 
@@ -176,8 +315,10 @@ class ParseRoster:
             if (row_num > (len(day) - 4)
                     or (end_of_duty and row_num > end_of_duty + 2)):
                 break
+
             # Skip empty and non-relevant rows
-            elif row in ParseRoster.skip_vals or len(row) < 3:
+            token = tokenize(row)
+            if token.kind == "skip":
                 skip_row += 1
                 # More than 3 empty rows means no more items that day
                 if skip_row > 3:
@@ -190,18 +331,17 @@ class ParseRoster:
             skip_row = end_of_duty = 0
 
             # Check what's happening on row
-            self.search_duty_type(row)
-            search_time = re.search(r"[0-9]{2}:[0-9]{2}", row)
+            self.search_duty_type(token)
 
             # If current row is a time, check what type of activity
-            if search_time:
-                time = search_time.group()
+            if token.time is not None:
+                time = token.time
 
                 # If new day but still values in cache, save those first.
                 ongoing = (self.lv.get("last_type") == "off_time"
                            or self.lv.get("last_type") == "end_time")
-                if (ongoing and (time_diff(self.lv["last_time"], time)
-                                 > timedelta(hours=9))):
+                if (ongoing and (minutes_between(self.lv["last_time"], time)
+                                 > NEW_DAY_GAP)):
                     self.clean_up(end_of_duty=True, keep_duty_type=True)
 
                 # Determine what type of time we're dealing with
@@ -209,24 +349,24 @@ class ParseRoster:
                 previous_item = self.lv.get("previous_item")
 
             # Fetch details about flight
-            elif "flight_number" in self.lv and row not in GND_POS:
-                search_iata = re.search(r"[A-Z]{3}\Z", row)
-                if search_iata:
-                    self.flight_details(row, search_iata)
-                    continue
+            elif token.iata and "flight_number" in self.lv:
+                self.flight_details(token)
+                continue
 
             # When STA is set, all flight details are known so save duty
             if previous_item == "STA":
-                self.duties.append(Flight(self.lv["flight_number"],
-                                          self.lv["dep"], self.lv["arr"],
-                                          self.lv["STD"], self.lv["STA"],
-                                          position=self.lv.get("position"),
-                                          comeback=self.lv.get("comeback")))
+                # Flight is created once all airports of period are known
+                flight = (self.lv["flight_number"],
+                          self.lv["dep"], self.lv["arr"],
+                          self.lv["STD"], self.lv["STA"],
+                          self.lv.get("position"), self.lv.get("comeback"))
+                self.flights.append((self.duties, len(self.duties), flight))
+                self.add_duty(flight)
                 self.clean_up()
 
             # If not a flight but end/no time set, save as OtherDuty
             elif previous_item == "end_time" or "no_time" in self.lv:
-                self.duties.append(
+                self.add_duty(
                     OtherDuty(self.lv["other_duty"],
                               start_time=self.lv.get("start_time"),
                               end_time=self.lv.get("end_time"))
@@ -239,79 +379,304 @@ class ParseRoster:
                 end_of_duty = row_num
 
 
+@lru_cache(maxsize=8192)
+def tokenize(row):
+    """Classify the text of one roster cell once, as a Token.
+
+    Rows repeat a lot within a roster, so tokens are cached per text.
+    Times are converted to minutes since midnight here, once."""
+
+    if row in ParseRoster.skip_vals or len(row) < 3:
+        return Token("skip", row, None, None, None, False, None, None, False)
+    if row in GND_POS:
+        return Token("ground", row, None, None, None, False, None, None,
+                     False)
+
+    flight_number = FLIGHT_NUMBER.search(row)
+    if flight_number:
+        flight_number = flight_number.group()
+    comeback = row[-1] if row[-1] in "RA" else None
+    duty = NON_FLIGHT.search(row)
+    if duty:
+        duty = duty.group()
+    time = TIME.search(row)
+    if time:
+        time = to_minutes(time.group())
+    iata = IATA.search(row)
+    if iata:
+        iata = iata.group()
+    return Token(None, row, flight_number, comeback, duty,
+                 duty in ParseRoster.timed_roster_codes, time, iata,
+                 "*" in row)
+
+
+# Tokens depend on the roster codes, so start over when they are reloaded
+registry.listeners.append(lambda data: tokenize.cache_clear())
+
+
+class RosterExtractor(HTMLParser):
+    """Event driven parser which only keeps the cells of roster rows.
+
+    Mimics str(cell.string) of BeautifulSoup for every <td> without
+    building a document tree. Each open element is kept as a frame:
+    [tag, number of children, string of single child, last child is text].
+    """
+
+    # Elements without content
+    void_tags = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+                 "keygen", "link", "meta", "param", "source", "track",
+                 "wbr", "basefont", "bgsound", "command", "frame", "image",
+                 "isindex", "menuitem", "nextid", "spacer"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.closed_voids = []
+        self.open_rows = []
+        self.rows = []
+        # Name of the first hotel found, with the text of its element
+        # until that element is closed, and the dates in that text
+        self.hotel = None
+        self.hotel_frame = None
+        self.hotel_text = []
+        self.night_stops = []
+
+    def add_child(self, string, text=False):
+        """Register a new child node with the innermost open element."""
+
+        if self.stack:
+            parent = self.stack[-1]
+            if text and parent[3]:
+                # Text split over several events is still one node
+                parent[2] += string
+            else:
+                parent[1] += 1
+                parent[2] = string
+                parent[3] = text
+
+    def handle_starttag(self, tag, attrs, empty=True):
+        self.add_child(None)
+        frame = [tag, 0, None, False]
+        self.stack.append(frame)
+
+        if tag == "tr":
+            row = []
+            self.open_rows.append(row)
+            self.rows.append(row)
+        elif tag == "td":
+            # Cells also count for every row the cell is nested in
+            for row in self.open_rows:
+                row.append(frame)
+
+        # Void elements are closed straight away, their end tag is ignored
+        if empty and tag in RosterExtractor.void_tags:
+            self.handle_endtag(tag, check_closed=False)
+            self.closed_voids.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, empty=False)
+        self.handle_endtag(tag, check_closed=False)
+
+    def handle_endtag(self, tag, check_closed=True):
+        if check_closed and tag in self.closed_voids:
+            self.closed_voids.remove(tag)
+            return
+        if self.stack:
+            self.stack[-1][3] = False
+
+        # Close the most recent matching element, ignore stray end tags
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                break
+        else:
+            return
+        while len(self.stack) > i:
+            self.close_element()
+
+    def close_element(self):
+        """Pop innermost element and pass its string on to the parent."""
+
+        frame = self.stack.pop()
+        if frame is self.hotel_frame:
+            self.night_stops = night_stops("".join(self.hotel_text))
+            self.hotel_frame = None
+        if frame[0] == "tr":
+            row = self.open_rows.pop()
+            # Free the cells of rows which are not part of the roster
+            if len(row) != 32:
+                row.clear()
+        if self.stack:
+            parent = self.stack[-1]
+            parent[2] = element_string(frame)
+            parent[3] = False
+
+    def handle_data(self, data):
+        self.add_child(data, text=True)
+        if self.hotel_frame is not None:
+            self.hotel_text.append(data)
+        elif self.hotel is None and self.stack:
+            self.find_hotel(self.stack[-1])
+
+    def find_hotel(self, parent):
+        """Start collecting night stops if the text in parent names a hotel.
+
+        Like soup.find(string=HOTEL).parent of BeautifulSoup, except that
+        text before the hotel in the same element is not searched."""
+
+        # Text node of parent so far, it may come in several parts
+        text = parent[2] if parent[3] else ""
+        match = HOTEL.search(text) if "HOTEL" in text else None
+        if match:
+            self.hotel = match.group()
+            self.hotel_frame = parent
+            self.hotel_text = [parent[2]]
+
+    def handle_comment(self, data):
+        self.add_child(data)
+
+    def handle_pi(self, data):
+        self.add_child(data)
+
+    def close(self):
+        super().close()
+        while self.stack:
+            self.close_element()
+
+    def columns(self):
+        """Yield the roster one column (day) at a time."""
+
+        rows = [[str(element_string(cell)) for cell in row]
+                for row in self.rows if len(row) == 32]
+        for column in range(32):
+            yield [row[column] for row in rows]
+
+    def period(self):
+        """Return the columns together with the night stops."""
+
+        return Period(self.columns(), self.hotel, self.night_stops)
+
+
+class Period:
+    """Columns of one roster with the night stops listed below its table.
+
+    Iterates like the columns themselves, so a plain list of columns can
+    be parsed as well, without night stops."""
+
+    def __init__(self, columns, hotel=None, night_stops=()):
+        """
+        :param columns: Iterable of lists, one per column of the roster.
+        :param hotel: Name of the hotel of the night stops.
+        :param night_stops: Days of month with a night stop."""
+
+        self.columns = columns
+        self.hotel = hotel
+        self.night_stops = night_stops
+
+    def __iter__(self):
+        return iter(self.columns)
+
+
+def element_string(frame):
+    """Return the equivalent of BeautifulSoup's .string for a frame."""
+
+    if frame[1] != 1:
+        return None
+    string = frame[2]
+    # Whitespace-only strings are collapsed like BeautifulSoup does
+    if frame[3] and not string.strip(" \n\t\x0c\r"):
+        return "\n" if "\n" in string else " "
+    return string
+
+
 def read_html(source):
-    """Read html file and return nested list with rows per column."""
+    """Read html file in chunks and return its rows per column.
 
-    # First try to open html file.
-    try:
-        with open(source) as html:
-            soup = BeautifulSoup(html.read(), "html.parser")
-    except FileNotFoundError:
-        exit("File not found!")
+    :param source: Path of the html roster file.
+    :return: Period, iterating over lists, one per column of the roster
+        table.
+    :raises FileNotFoundError: If there is no file at source."""
 
-    # Find the relevant cells and convert to strings
-    rows = []
-    for row in soup.find_all("tr"):
-        cells = [str(cell.string) for cell in row.find_all("td")]
+    with open(source) as html:
+        return read_stream(html)
 
-        # Turns out each row of the actual roster is 32 cells wide
-        if len(cells) == 32:
-            rows.append(cells)
 
-    # Transpose rows to columns
-    return [[row[column] for row in rows] for column in range(32)]
+def read_html_bytes(data, encoding="utf-8"):
+    """Read html roster from memory, e.g. an upload which is not saved.
 
+    :param data: Contents of the html file as bytes.
+    :return: Period, iterating over lists, one per column of the roster
+        table."""
 
-def night_stops(soup):
-    """Check box below roster table for any hotel information."""
+    html = io.TextIOWrapper(io.BytesIO(data), encoding=encoding,
+                            errors="replace")
+    return read_stream(html)
 
-    s = soup.find(string=re.compile(r"[A-Za-z]{6,12} HOTEL"))
-    if s is not None:
-        return re.findall(r"[A-Z][a-z]{2}[0-9]{2}", str(s.parent))
 
+@metrics.timed("read_html")
+def read_stream(html):
+    """Feed text stream in chunks to extractor and return its columns."""
 
-def only_count(days): # NOQA
+    extractor = RosterExtractor()
+    for chunk in iter(lambda: html.read(CHUNK_SIZE), ""):
+        extractor.feed(chunk)
+    extractor.close()
+
+    return extractor.period()
+
+
+def night_stops(text):
+    """Return days of month of the dates in the hotel block, e.g. Jan05.
+
+    The roster does not name its month, so that is the month most dates
+    are in, the first one listed on a tie. Dates of other months, e.g.
+    Feb01 after a night stop on Jan31, are not days of this roster."""
+
+    dates = NIGHT_STOP_DATE.findall(text)
+    if not dates:
+        return []
+    month = Counter(date[:3] for date in dates).most_common(1)[0][0]
+    return [int(date[3:]) for date in dates if date[:3] == month]
+
+
+@metrics.timed("only_count")
+def only_count(days):
     """Take list of days and return count of roster items.
 
     :param days: List of DutyDay objects.
     :return: Dictionary of roster items with their count."""
 
-    master_count = defaultdict(int)
+    return summarize(count_days(days))
 
-    # Sum up duties of full period
+
+def count_days(days, count=None):
+    """Add up the items of each day, without converting to a summary.
+
+    :param days: List of DutyDay objects.
+    :param count: Earlier count to add to, e.g. a stored running total.
+    :return: Dictionary of item with count, sectors multiplied by 10."""
+
+    count = defaultdict(int, count or {})
     for d in days:
         activities = d.count_items()
         for key, value in activities.items():
             try:
-                master_count[key] += value
+                count[key] += value
             except TypeError:
                 # Key/value is bool
-                master_count[key] += 1
+                count[key] += 1
+    return dict(count)
+
+
+def summarize(count):
+    """Convert count of count_days into a summary of roster items."""
+
+    master_count = defaultdict(int, count)
     master_count["num_sectors"] = master_count["num_sectors"] / 10 # NOQA
 
     return summary_description(master_count)
 
 
 if __name__ == '__main__':
-    months = []
-    year = 17
-    month_start = 8
-    num_months = 1
-    path = r"C:\Users\Rinze\Documents\Werk\rooster"
-    for i in range(month_start, month_start + num_months):
-        print(f"month {i}")
-        file = rf"20{year}\{year}-{i:02d}.htm"
-        months.extend(read_html(r"\\".join([path, file])))
-
-    pr = ParseRoster()
-    days = pr.results(months)
-    for i, day in enumerate(days):
-        print(f"Day {i+1}")
-        for duty in day.duties:
-            print(duty)
-
-    print("")
-
-    count = only_count(days)
-    for k, v in count.items():
-        print(f"{k}: {v}.")
+    # Command line use is handled by the batch processor
+    from batch import main
+    exit(main())
@@ -0,0 +1,103 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import cProfile
+import os
+import pstats
+import threading
+from collections import defaultdict, namedtuple
+
+from process import ParseRoster, read_html, only_count
+
+# Only one profiler can be active at a time
+profile_lock = threading.Lock()
+# Paths deeper than this are cut off in the collapsed stacks
+MAX_DEPTH = 64
+
+HotFunction = namedtuple("HotFunction", ["function", "calls", "tottime",
+                                         "cumtime"])
+
+
+def profile_roster(path, top=20, output=None):
+    """Parse roster file under cProfile and save the profile next to it.
+
+    Writes output.pstats for pstats or snakeviz, and output.collapsed
+    with one stack per line for flamegraph.pl or speedscope.
+
+    :param path: Location of the html roster file.
+    :param top: Number of functions in the returned table.
+    :param output: Location of the profile without extension, by
+        default path.
+    :return: List of DutyDay objects, count of roster items and list of
+        HotFunction with the most time spent in the function itself."""
+
+    def pipeline():
+        days = ParseRoster().results(read_html(path))
+        return days, only_count(days)
+
+    profile = cProfile.Profile()
+    with profile_lock:
+        # One root function gives one stack for the whole parse
+        days, count = profile.runcall(pipeline)
+
+    output = output or path
+    stats = pstats.Stats(profile)
+    stats.dump_stats(output + ".pstats")
+    with open(output + ".collapsed", "w") as file:
+        for stack, seconds in collapsed_stacks(stats.stats).items():
+            microseconds = round(seconds * 1e6)
+            if microseconds:
+                file.write(f"{stack} {microseconds}\n")
+    return days, count, hot_functions(stats.stats, top)
+
+
+def hot_functions(stats, top=20):
+    """Return the functions with most time spent in the function itself."""
+
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)
+    return [HotFunction(label(func), nc, tt, ct)
+            for func, (cc, nc, tt, ct, callers) in rows[:top]]
+
+
+def collapsed_stacks(stats):
+    """Convert profile into call stacks with the time spent on each.
+
+    cProfile only records which function called which, not full stacks.
+    Time of a function is divided over its callers in proportion to the
+    time spent in each call, like flameprof and gprof2dot do.
+
+    :param stats: The stats attribute of a pstats.Stats object.
+    :return: Dictionary of stack as "outer;...;inner" with seconds."""
+
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+
+    stacks = defaultdict(float)
+
+    def walk(func, path, share):
+        path = path + (func,)
+        stacks[";".join(map(label, path))] += stats[func][2] * share
+        if len(path) >= MAX_DEPTH:
+            return
+        for callee, edge in callees[func].items():
+            # Recursion is shown once, deeper calls add to the first
+            cumtime = stats.get(callee, (0, 0, 0, 0))[3]
+            if callee in path or cumtime <= 0:
+                continue
+            walk(callee, path, share * edge[3] / cumtime)
+
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            walk(func, (), 1.0)
+    return stacks
+
+
+def label(func):
+    """Return readable name of a pstats function key."""
+
+    filename, line, name = func
+    if filename == "~":
+        # Built in functions have no file
+        return name.replace(";", ",")
+    return f"{name} ({os.path.basename(filename)}:{line})".replace(";", ",")
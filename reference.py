@@ -0,0 +1,171 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import os
+import pickle
+import threading
+import time
+
+from files import atomic_write
+
+# Reference files are next to this module, unless set otherwise
+DATA_DIR = os.environ.get("ROSTER_DATA_DIR",
+                          os.path.dirname(os.path.abspath(__file__)))
+SOURCES = ["airports.csv", "other_duties.csv"]
+# Optional precompiled copy of the sources, used when it exists
+SNAPSHOT = "reference.pickle"
+
+
+class ReferenceData:
+    """Airports and roster codes as read from the sources at one time."""
+
+    def __init__(self, airports, roster_codes, stats):
+        """
+        :param airports: Dictionary of IATA code with Airport object.
+        :param roster_codes: Dictionary of code with its csv values.
+        :param stats: Size and mtime of the sources, see Registry.stats."""
+
+        self.airports = airports
+        self.roster_codes = roster_codes
+        self.stats = stats
+        self.timed_codes = frozenset(code for code, values
+                                     in roster_codes.items()
+                                     if values[0] == "True")
+        self.paid_codes = frozenset(code for code, values
+                                    in roster_codes.items()
+                                    if values[2] == "True")
+        self.off_codes = frozenset(code for code, values
+                                   in roster_codes.items()
+                                   if values[1] == "off")
+        self.gnd_training = frozenset(code for code, values
+                                      in roster_codes.items()
+                                      if (values[1] in ["training",
+                                                        "recurrent"]
+                                          and values[2] == "True"))
+
+
+class Registry:
+    """Loads reference data once, on first use, and again when it changed.
+
+    The sources are checked at most once per check_interval seconds, so
+    reading a value costs next to nothing. Load in a parent process
+    before forking and all workers share the same copy."""
+
+    def __init__(self, directory=DATA_DIR, check_interval=1.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.data = None
+        self.checked = 0.0
+        self.lock = threading.RLock()
+        # Called with the new ReferenceData after every load
+        self.listeners = []
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def current(self):
+        """Return ReferenceData, loading it first if missing or outdated."""
+
+        data = self.data
+        if (data is None
+                or time.monotonic() - self.checked > self.check_interval):
+            with self.lock:
+                if self.data is None or self.stats() != self.data.stats:
+                    self.load()
+                self.checked = time.monotonic()
+                data = self.data
+        return data
+
+    def load(self):
+        """Read the snapshot if it is up to date, else the sources."""
+
+        with self.lock:
+            stats = self.stats()
+            data = self.read_snapshot(stats)
+            if data is None:
+                # Import here, datastructures itself uses the registry
+                from datastructures import get_airports, get_rostercodes
+                data = ReferenceData(
+                    get_airports(self.path("airports.csv")),
+                    get_rostercodes(self.path("other_duties.csv")), stats)
+                if os.path.exists(self.path(SNAPSHOT)):
+                    self.write_snapshot(data)
+            self.data = data
+            self.checked = time.monotonic()
+            for listener in self.listeners:
+                listener(data)
+
+    def use(self, directory):
+        """Switch to the sources in another directory."""
+
+        with self.lock:
+            self.directory = directory
+            self.load()
+
+    def refresh(self, name, previous=None):
+        """Accept a source as written, when its change is already loaded.
+
+        Prevents a reload after e.g. adding imported airports to the
+        file which are already in the loaded airports.
+
+        :param previous: Stat of the source before the write. If given,
+            only accepted when that was the loaded version, so changes
+            of other processes are still loaded."""
+
+        with self.lock:
+            if self.data is not None and (
+                    previous is None
+                    or self.data.stats.get(name) == previous):
+                self.data.stats = dict(self.data.stats,
+                                       **{name: self.stat(name)})
+
+    def stats(self):
+        """Return size and mtime of every source, None if missing."""
+
+        return {name: self.stat(name) for name in SOURCES}
+
+    def stat(self, name):
+        try:
+            stat = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def read_snapshot(self, stats):
+        """Return data of snapshot, None if missing or not up to date."""
+
+        try:
+            with open(self.path(SNAPSHOT), "rb") as file:
+                data = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            return None
+        return data if data.stats == stats else None
+
+    def write_snapshot(self, data):
+        """Write data to the snapshot file in one go."""
+
+        atomic_write(self.path(SNAPSHOT),
+                     pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+
+class Reference:
+    """Class attribute which reads its value from the registry."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        return getattr(registry.current(), self.name)
+
+
+registry = Registry()
+
+
+def data_path(name):
+    """Return location of a reference file in the data directory."""
+
+    return registry.path(name)
+
+
+if __name__ == "__main__":
+    # Build the snapshot, later loads use it while the sources don't change
+    registry.write_snapshot(registry.current())
@@ -0,0 +1,219 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import heapq
+import math
+import re
+import threading
+from collections import deque
+
+from datastructures import Flight
+from distances import EARTH_RADIUS, KM_PER_NM
+from reference import registry
+
+# Order of matches in a search, codes before names
+IATA, ICAO, NAME = 0, 1, 2
+WORD = re.compile(r"[^\W_]+")
+
+
+class PrefixTrie:
+    """Values stored under keys, found by any prefix of their key.
+
+    Keys are case insensitive. Every node is a dict of character with
+    child node, values of a complete key are listed under None."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, key, value):
+        node = self.root
+        for char in key.casefold():
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def find(self, prefix):
+        """Return values of all keys starting with prefix.
+
+        Shorter keys come first, so an exact match is first of all."""
+
+        node = self.root
+        for char in prefix.casefold():
+            node = node.get(char)
+            if node is None:
+                return []
+
+        found = []
+        queue = deque([node])
+        while queue:
+            node = queue.popleft()
+            found.extend(node.get(None, ()))
+            queue.extend(child for char, child in sorted(
+                (item for item in node.items() if item[0] is not None),
+                key=lambda item: item[0]))
+        return found
+
+
+class KDTree:
+    """k-d tree of points, for nearest neighbours by straight distance.
+
+    Nodes are kept in lists instead of objects: the point of node n is
+    points[index[n]], left[n] and right[n] are its children or -1."""
+
+    def __init__(self, points):
+        """
+        :param points: Sequence of coordinate tuples of equal length."""
+
+        self.points = [tuple(point) for point in points]
+        self.dims = len(self.points[0]) if self.points else 0
+        self.index, self.left, self.right = [], [], []
+        self.root = self.build(list(range(len(self.points))), 0)
+
+    def build(self, indices, depth):
+        """Add median of indices as node and its halves as children."""
+
+        if not indices:
+            return -1
+        axis = depth % self.dims
+        indices.sort(key=lambda i: self.points[i][axis])
+        middle = len(indices) // 2
+
+        node = len(self.index)
+        self.index.append(indices[middle])
+        self.left.append(-1)
+        self.right.append(-1)
+        self.left[node] = self.build(indices[:middle], depth + 1)
+        self.right[node] = self.build(indices[middle + 1:], depth + 1)
+        return node
+
+    def nearest(self, point, k=1):
+        """Return list of (distance, index of point) of the k nearest."""
+
+        # Max heap of the best so far, on negative squared distance
+        best = []
+
+        def visit(node, depth):
+            if node < 0:
+                return
+            other = self.points[self.index[node]]
+            squared = sum((a - b) ** 2 for a, b in zip(point, other))
+            if len(best) < k:
+                heapq.heappush(best, (-squared, self.index[node]))
+            elif squared < -best[0][0]:
+                heapq.heapreplace(best, (-squared, self.index[node]))
+
+            axis = depth % self.dims
+            diff = point[axis] - other[axis]
+            near, far = ((self.left[node], self.right[node]) if diff < 0
+                         else (self.right[node], self.left[node]))
+            visit(near, depth + 1)
+            # Other side can only be closer when the split plane is
+            if len(best) < k or diff * diff < -best[0][0]:
+                visit(far, depth + 1)
+
+        if k > 0:
+            visit(self.root, 0)
+        return sorted((math.sqrt(-squared), i) for squared, i in best)
+
+
+class AirportSearch:
+    """Airports of the reference data by code, name and location.
+
+    Names and codes are in a prefix trie, locations in a k-d tree of
+    points on the unit sphere, where the straight distance between two
+    points grows with the great circle distance."""
+
+    current_index = None
+    lock = threading.Lock()
+
+    def __init__(self, airports):
+        """
+        :param airports: Dictionary of IATA code with Airport object."""
+
+        self.airports = dict(airports)
+        self.trie = PrefixTrie()
+        located = []
+        for airport in self.airports.values():
+            self.trie.add(airport.iata, (IATA, airport.iata))
+            self.trie.add(airport.icao, (ICAO, airport.iata))
+            # Whole name and each word, e.g. "Orly" for "Paris Orly"
+            self.trie.add(airport.name, (NAME, airport.iata))
+            for word in WORD.findall(airport.name)[1:]:
+                self.trie.add(word, (NAME, airport.iata))
+            if all(map(math.isfinite, airport.latlong)):
+                located.append(airport.iata)
+        self.located = located
+        self.tree = KDTree([unit_vector(*self.airports[iata].latlong)
+                            for iata in located])
+
+    @classmethod
+    def current(cls):
+        """Return index of the current reference data, built once.
+
+        Built again after a reload, or when airports were imported."""
+
+        airports = registry.current().airports
+        with cls.lock:
+            index = cls.current_index
+            if index is None or index.airports != airports:
+                index = cls.current_index = cls(airports)
+        return index
+
+    def find(self, prefix, limit=10):
+        """Return airports with IATA, ICAO or name starting with prefix.
+
+        Airports matching on IATA code come first, then ICAO, then name."""
+
+        prefix = prefix.strip()
+        if not prefix:
+            return []
+        seen = set()
+        found = []
+        for _, iata in sorted(self.trie.find(prefix), key=lambda m: m[0]):
+            if iata not in seen:
+                seen.add(iata)
+                found.append(self.airports[iata])
+                if len(found) == limit:
+                    break
+        return found
+
+    def nearest(self, lat, long, k=5):
+        """Return list of (Airport, distance in nm) nearest to a point."""
+
+        return [(self.airports[self.located[i]], chord_to_nm(chord))
+                for chord, i in self.tree.nearest(unit_vector(lat, long), k)]
+
+    def distance(self, dep, arr):
+        """Return length, sector and nominal of a flight between airports.
+
+        :param dep: IATA code of departure airport.
+        :param arr: IATA code of arrival airport.
+        :raises KeyError: If either airport is not known.
+        :raises ValueError: If either has no valid coordinates."""
+
+        pair = self.airports[dep.upper()], self.airports[arr.upper()]
+        return Flight.distance_memo.sector_lengths([pair])[0]
+
+
+def unit_vector(lat, long):
+    """Return point on the unit sphere of latitude and longitude."""
+
+    lat, long = math.radians(lat), math.radians(long)
+    return (math.cos(lat) * math.cos(long),
+            math.cos(lat) * math.sin(long),
+            math.sin(lat))
+
+
+def chord_to_nm(chord):
+    """Convert straight distance on the unit sphere into great circle nm."""
+
+    return EARTH_RADIUS * 2 * math.asin(min(chord / 2, 1.0)) / KM_PER_NM
+
+
+def airport_record(airport):
+    """Return Airport as dict of plain values."""
+
+    lat, long = airport.latlong
+    return {"iata": airport.iata,
+            "icao": airport.icao,
+            "name": airport.name,
+            "lat": lat if math.isfinite(lat) else None,
+            "long": long if math.isfinite(long) else None}
@@ -0,0 +1,168 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import os
+import sqlite3
+import threading
+import time
+
+from cache import content_hash
+from files import atomic_write
+from metrics import metrics
+
+BLOB_DIR = "blobs"
+INDEX = "uploads.sqlite"
+# Files saved before the store are only read with these extensions
+ROSTER_EXTENSIONS = (".htm", ".html")
+# Seconds before a blob which is not in the index is deleted
+ORPHAN_AGE = 3600
+
+
+class UploadStore:
+    """Uploaded rosters stored once per content, under their SHA-256.
+
+    An index maps the names users uploaded them as to the blobs. The
+    same file uploaded again takes no extra space, a different file with
+    a name already taken is stored under a name of its own. Rosters saved
+    directly in the folder, from before the store, can still be read."""
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, index=None):
+        """
+        :param directory: Uploads folder, blobs go in a subfolder.
+        :param max_bytes: Total size of blobs kept, see collect.
+        :param index: Path of the index, best outside a folder which is
+            served. In directory if not given."""
+
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, BLOB_DIR)
+        self.index = index or os.path.join(directory, INDEX)
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        # Connection with the process which opened it, like ResultCache
+        self.connection = None, None
+        os.makedirs(self.blob_dir, exist_ok=True)
+        # Index of an older version, which kept it in directory
+        old_index = os.path.join(directory, INDEX)
+        if not os.path.exists(self.index) and os.path.exists(old_index):
+            os.replace(old_index, self.index)
+
+    @property
+    def db(self):
+        """Return SQLite connection of this process, opened on first use."""
+
+        pid, db = self.connection
+        if pid != os.getpid():
+            db = sqlite3.connect(self.index, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS names ("
+                       "name TEXT PRIMARY KEY, blob TEXT, accessed REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                       "digest TEXT PRIMARY KEY, size INTEGER)")
+            db.commit()
+            self.connection = os.getpid(), db
+        return db
+
+    def add(self, name, data):
+        """Store upload and return the name it can be found under.
+
+        :param name: Name of the file as uploaded, made safe already.
+        :param data: Contents of the file as bytes.
+        :return: name, or name with part of the hash when name is
+            already taken by another file."""
+
+        digest = content_hash(data)
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            metrics.inc("uploads_deduplicated")
+        else:
+            atomic_write(path, data)
+
+        with self.lock:
+            row = self.db.execute("SELECT blob FROM names WHERE name = ?",
+                                  (name,)).fetchone()
+            if row is not None and row[0] != digest:
+                stem, ext = os.path.splitext(name)
+                name = f"{stem}-{digest[:8]}{ext}"
+            self.db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?)",
+                            (digest, len(data)))
+            self.db.execute("INSERT OR REPLACE INTO names VALUES (?, ?, ?)",
+                            (name, digest, time.time()))
+            self.db.commit()
+            self.collect(keep=digest)
+        return name
+
+    def resolve(self, name):
+        """Return path of the file uploaded as name.
+
+        :raises FileNotFoundError: If there is no such upload."""
+
+        with self.lock:
+            row = self.db.execute("SELECT blob FROM names WHERE name = ?",
+                                  (name,)).fetchone()
+            if row is not None:
+                self.db.execute("UPDATE names SET accessed = ? "
+                                "WHERE name = ?", (time.time(), name))
+                self.db.commit()
+                return self.blob_path(row[0])
+
+        # Saved under its own name before there was a store. Other files
+        # in the folder are not uploads, so are never returned.
+        path = os.path.join(self.directory, os.path.basename(name))
+        if (not path.lower().endswith(ROSTER_EXTENSIONS)
+                or not os.path.isfile(path)):
+            raise FileNotFoundError(name)
+        return path
+
+    def read(self, name):
+        """Return contents of the file uploaded as name."""
+
+        with open(self.resolve(name), "rb") as file:
+            return file.read()
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def collect(self, keep=None):
+        """Delete least recently used blobs until they fit in max_bytes.
+
+        Names of a deleted blob are dropped from the index too. Blobs
+        left out of the index, e.g. after a crash, are deleted once they
+        are older than ORPHAN_AGE.
+
+        :param keep: Digest of a blob not to delete, e.g. the newest."""
+
+        with self.lock:
+            blobs = self.db.execute(
+                "SELECT digest, size FROM blobs LEFT JOIN names "
+                "ON blob = digest GROUP BY digest "
+                "ORDER BY MAX(accessed)").fetchall()
+            total = sum(size for _, size in blobs)
+            for digest, size in blobs:
+                if total <= self.max_bytes:
+                    break
+                if digest == keep:
+                    continue
+                self.db.execute("DELETE FROM names WHERE blob = ?", (digest,))
+                self.db.execute("DELETE FROM blobs WHERE digest = ?",
+                                (digest,))
+                self.remove(digest)
+                total -= size
+                metrics.inc("uploads_collected")
+            self.db.commit()
+
+            # Another process may be about to add a new blob to the index
+            known = {digest for digest, _ in blobs}
+            cutoff = time.time() - ORPHAN_AGE
+            for filename in os.listdir(self.blob_dir):
+                if filename in known:
+                    continue
+                try:
+                    modified = os.path.getmtime(self.blob_path(filename))
+                except FileNotFoundError:
+                    continue
+                if modified < cutoff:
+                    self.remove(filename)
+
+    def remove(self, digest):
+        try:
+            os.remove(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
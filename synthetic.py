@@ -0,0 +1,264 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import argparse
+import calendar
+import csv
+import os
+import random
+from html import escape
+
+from reference import data_path
+
+# Airports from airports.csv used as destinations
+DESTINATIONS = ["AMS", "GVA", "TLS", "NTE", "AGP", "LYS", "NCE", "CDG", "FCO",
+                "TXL", "FAO", "PRG", "RAK", "VCE", "EDI", "BIO", "CPH", "MXP",
+                "BFS", "TLV", "TFS", "KTT", "ZRH", "LIS", "ACE", "PFO", "HEL"]
+STANDBY_CODES = ["ASBY", "ADTY", "HSBY"]
+GROUND_CODES = ["SIM", "CRM", "FIRE", "SEP", "EMED", "OFC8", "MEET"]
+OFF_CODES = ["D/O", "D/O", "D/O", "WD/O", "LVE", "SICK", "ULV"]
+HOTELS = ["GRANDHOTEL", "NOVOTEL", "RADISSON", "CROWNEPLAZA"]
+# Codes the parser reads as something else than an airport
+RESERVED = {"OWN", "TRN", "NSO", "EZS", "EJU"}
+
+
+class RosterGenerator:
+    """Generate roster files in the 32 column layout read_html expects.
+
+    Column 0 holds the row labels, columns 1 to 31 the days of the month.
+    Every day lists its duties top down, followed by empty cells and the
+    block and duty times in the last three rows."""
+
+    def __init__(self, months=1, flights_per_day=3, standby_share=0.1,
+                 ground_share=0.1, unknown_airport_ratio=0.0, seed=0,
+                 start=(2019, 1), base="LGW", known=None,
+                 night_stop_share=0.0):
+        """
+        :param months: Number of consecutive monthly rosters.
+        :param flights_per_day: Average number of sectors on a flying day.
+        :param standby_share: Share of days with standby duties.
+        :param ground_share: Share of days with ground duties.
+        :param unknown_airport_ratio: Share of destinations which are not
+            in airports.csv and have to be imported.
+        :param known: IATA codes to avoid for unknown airports, by default
+            those of airports.csv.
+        :param night_stop_share: Share of flying days listed in the
+            hotel block below the table."""
+
+        self.months = months
+        self.flights_per_day = flights_per_day
+        self.standby_share = standby_share
+        self.ground_share = ground_share
+        self.unknown_airport_ratio = unknown_airport_ratio
+        self.night_stop_share = night_stop_share
+        self.rng = random.Random(seed)
+        self.start = start
+        self.base = base
+        if known is None:
+            known = known_airports()
+        self.known = set(known) | RESERVED
+        self.unknown_airports = {}
+
+    def rosters(self):
+        """Return list of (file name, html) with one roster per month."""
+
+        year, month = self.start
+        rosters = []
+        for _ in range(self.months):
+            rosters.append((f"{year % 100:02d}-{month:02d}.htm",
+                            self.month(year, month)))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return rosters
+
+    def month(self, year, month):
+        """Return html of the roster of one month."""
+
+        num_days = calendar.monthrange(year, month)[1]
+        days = [self.day() if d < num_days else [] for d in range(31)]
+        height = max(map(len, days)) + 9
+
+        # Header of each column, then duties and padding, then block/duty
+        columns = [["", ""] + [""] * (height - 5) + ["Block", "Duty", ""]]
+        for d, items in enumerate(days):
+            header = ["", ""]
+            if d < num_days:
+                weekday = calendar.weekday(year, month, d + 1)
+                header = [calendar.day_abbr[weekday][:2], f"{d + 1:02d}"]
+            padding = [""] * (height - 5 - len(items))
+            block = ["", "", ""]
+            if items and ":" in items[-1]:
+                block = ["05:30", "09:15", ""]
+            columns.append(header + items + padding + block)
+
+        rows = ["<tr>" + "".join(f"<td>{escape(column[r])}</td>"
+                                 for column in columns) + "</tr>"
+                for r in range(height)]
+        return ("<html><head><title>Roster</title></head><body>\n"
+                f"<h1>Roster {calendar.month_name[month]} {year}</h1>\n"
+                '<table class="roster">\n' + "\n".join(rows) + "\n</table>\n"
+                + self.hotel_block(month, days) + "</body></html>\n")
+
+    def hotel_block(self, month, days):
+        """Return paragraph listing night stops after some flying days."""
+
+        if not self.night_stop_share:
+            return ""
+        # Flying days start with a flight number
+        dates = [f"{calendar.month_abbr[month]}{d + 1:02d}"
+                 for d, items in enumerate(days)
+                 if items and items[0][0].isdigit()
+                 and self.rng.random() < self.night_stop_share]
+        if not dates:
+            return ""
+        return (f"<p>{self.rng.choice(HOTELS)}&nbsp;HOTEL "
+                + " ".join(dates) + "</p>\n")
+
+    def day(self):
+        """Return the cells of one random day."""
+
+        draw = self.rng.random()
+        if draw < self.standby_share:
+            return self.standby_day()
+        elif draw < self.standby_share + self.ground_share:
+            return self.ground_day()
+        elif draw < 1 - (1 - self.standby_share - self.ground_share) * 0.4:
+            return self.flying_day()
+        return [self.rng.choice(OFF_CODES)]
+
+    def standby_day(self):
+        code = self.rng.choice(STANDBY_CODES)
+        start = self.rng.randint(4 * 60, 14 * 60)
+        if code == "ADTY" and self.rng.random() < 0.5:
+            # Called out: start time repeated as report, then flights
+            return ([code, clock(start), clock(start)]
+                    + self.flights(start + 30, report=False))
+        return [code, clock(start), clock(start + self.rng.choice([180, 360,
+                                                                   480]))]
+
+    def ground_day(self):
+        start = self.rng.randint(6 * 60, 10 * 60)
+        return [self.rng.choice(GROUND_CODES), clock(start),
+                clock(start + self.rng.choice([240, 480]))]
+
+    def flying_day(self):
+        return self.flights(self.rng.randint(5 * 60, 14 * 60))
+
+    def flights(self, time, report=True):
+        """Return cells of a sequence of flights from and back to base."""
+
+        rng = self.rng
+        items = []
+        here = self.base
+        sectors = max(1, round(rng.gauss(self.flights_per_day, 0.7)))
+        for i in range(sectors):
+            dest = self.base if i == sectors - 1 else self.destination()
+            if i == 0 and rng.random() < 0.05:
+                number = rng.choice(["TAXI", "OWN"])
+            else:
+                number = str(rng.randint(1000, 9999))
+                draw = rng.random()
+                if draw < 0.02:
+                    number += "R"
+                elif draw < 0.04:
+                    number += "A"
+            items.append(number)
+
+            if i == 0 and report:
+                items.append(clock(time))
+                time += 45
+            items.append(clock(time))
+            star = "*" if rng.random() < 0.05 else ""
+            items += [star + here, dest]
+            time += rng.randint(50, 220)
+            items.append(clock(time))
+            time += rng.randint(35, 60)
+            here = dest
+
+        # Off duty time
+        items.append(clock(time - 15))
+        return items
+
+    def destination(self):
+        """Pick a destination, which may be an airport still to import."""
+
+        if self.rng.random() >= self.unknown_airport_ratio:
+            return self.rng.choice(DESTINATIONS)
+        # Reuse unknown airports now and then, like real rosters do
+        if self.unknown_airports and self.rng.random() < 0.5:
+            return self.rng.choice(sorted(self.unknown_airports))
+        while True:
+            iata = "".join(self.rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+                           for _ in range(3))
+            if iata not in self.known and iata not in self.unknown_airports:
+                break
+        self.unknown_airports[iata] = (f"Z{iata}", f"Synthetic {iata}",
+                                       round(self.rng.uniform(30, 65), 6),
+                                       round(self.rng.uniform(-15, 35), 6))
+        return iata
+
+    def write_all_airports(self, path):
+        """Write the unknown airports in the layout of all_airports.csv."""
+
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["ident", "iata_code", "gps_code", "municipality",
+                             "latitude_deg", "longitude_deg"])
+            for iata, (icao, name, lat, long) in self.unknown_airports.items():
+                writer.writerow([icao, iata, icao, name, lat, long])
+
+    def write(self, directory):
+        """Write roster files and all_airports.csv to directory."""
+
+        os.makedirs(directory, exist_ok=True)
+        names = []
+        for name, html in self.rosters():
+            with open(os.path.join(directory, name), "w") as file:
+                file.write(html)
+            names.append(name)
+        self.write_all_airports(os.path.join(directory, "all_airports.csv"))
+        return names
+
+
+def clock(minutes):
+    """Format minutes since midnight as HH:MM, wrapping past midnight."""
+
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+
+def known_airports(path=None):
+    """Return IATA codes in airports.csv, or none if it is not there."""
+
+    try:
+        with open(path or data_path("airports.csv"), "r",
+                  newline="") as file:
+            return {row["IATA"] for row in csv.DictReader(file, delimiter="|")}
+    except FileNotFoundError:
+        return set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write synthetic roster files for testing and benchmarks.")
+    parser.add_argument("directory")
+    parser.add_argument("-m", "--months", type=int, default=12)
+    parser.add_argument("-f", "--flights-per-day", type=float, default=3)
+    parser.add_argument("--standby", type=float, default=0.1,
+                        help="Share of standby days.")
+    parser.add_argument("--ground", type=float, default=0.1,
+                        help="Share of ground duty days.")
+    parser.add_argument("--unknown", type=float, default=0.0,
+                        help="Share of destinations not in airports.csv.")
+    parser.add_argument("--night-stops", type=float, default=0.0,
+                        help="Share of flying days with a night stop.")
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    generator = RosterGenerator(args.months, args.flights_per_day,
+                                args.standby, args.ground, args.unknown,
+                                args.seed,
+                                night_stop_share=args.night_stops)
+    for name in generator.write(args.directory):
+        print(os.path.join(args.directory, name))
+
+
+if __name__ == "__main__":
+    main()
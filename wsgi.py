@@ -0,0 +1,15 @@
+#  Copyright (c) 2020. Rinze Douma
+
+import gc
+
+from app import create_app
+from reference import registry
+
+# Read airports.csv and other_duties.csv before the server forks, with
+# preloading all workers then share these pages copy-on-write
+registry.current()
+application = create_app()
+
+# Collecting the preloaded objects in a worker writes to their pages and
+# copies them after all, so leave them out of garbage collection
+gc.freeze()